@@ -1,44 +1,65 @@
+import io
 import os
+import re
 import json
+import hashlib
+import mimetypes
+import gzip
+import zlib
 import logging
 import secrets
+import functools
+import time
 import search
+import previews
 import indexer
+import bloom
+import catalog
+import peer_health
+import peer_discovery
+import swarm
+import leader
+import admission
+import md5_catalog
 import sqlite3
 import settings
-from flask import Flask, render_template, redirect, request, jsonify, flash, send_file, abort, session, url_for
+from flask import Flask, Response, stream_with_context, render_template, redirect, request, jsonify, flash, send_file, abort, session, url_for
 from werkzeug.security import generate_password_hash, check_password_hash
-from colorlog import ColoredFormatter
+from werkzeug.exceptions import HTTPException
+from werkzeug.utils import safe_join
+from werkzeug.middleware.proxy_fix import ProxyFix
+from urllib.parse import quote
 from dotenv import load_dotenv
+from log_config import setup_logging
 from database import execute_query, init_db, create_sqlite_connection
-from scheduler import start_scheduler, schedule_tasks
+from scheduler import start_scheduler, schedule_tasks, job_table, warmup_status
 
 load_dotenv()
 
-# Logging configuration
-log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-formatter = ColoredFormatter(
-    "%(asctime)s - %(name)s - %(log_color)s%(levelname)s%(reset)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    log_colors={
-        'DEBUG': 'cyan',
-        'INFO': 'green',
-        'WARNING': 'yellow',
-        'ERROR': 'red',
-        'CRITICAL': 'bold_red',
-    }
-)
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(formatter)
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-logger.addHandler(console_handler)
+# One logging pipeline for the whole process, every module logs through it
+setup_logging()
+logger = logging.getLogger(__name__)
 
 DB_PATH = os.getenv("DB_PATH", "index.sqlite")
+MD5_PATTERN = re.compile(r"[0-9a-f]{32}")
+# Cache-Control for content addressed by md5, which can be cached forever
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Size in pixels previews are displayed at on result pages
+RESULT_PREVIEW_DISPLAY_SIZE = 150
+
+# Startup time of this worker, to report how long it took to serve its first request
+STARTED_AT = time.monotonic()
+first_request_after = None
 
 app = Flask(__name__)
 app.secret_key = secrets.token_hex(16)
 
+# Behind nginx every peer shares the proxy's address; take the client address from
+# X-Forwarded-For as set by that many trusted proxies, so per-peer limits stay per peer
+TRUSTED_PROXY_COUNT = int(os.getenv("TRUSTED_PROXY_COUNT") or 0)
+if TRUSTED_PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT)
+
 def setup_admin_credentials(username, password):
     hashed_password = generate_password_hash(password)
     with open('credentials.json', 'w') as f:
@@ -50,6 +71,98 @@ def load_credentials():
             return json.load(f)
     return {'username': 'admin', 'password': generate_password_hash('admin')}
 
+def stream_json_list(items):
+    """Serialize a list as a JSON array one item at a time, so large result sets are never encoded in one piece."""
+    yield '['
+    for i, item in enumerate(items):
+        yield (',' if i else '') + json.dumps(item)
+    yield ']'
+
+def compressed_response(body, mimetype, min_size=1024):
+    """
+    Build a response, gzip or deflate compressed when the client accepts it and the body is worth compressing.
+
+    Args:
+        body (str): The response body.
+        mimetype (str): The response media type.
+        min_size (int): Bodies smaller than this many bytes are sent as is.
+    """
+    data = body.encode('utf-8')
+    accepted = request.headers.get('Accept-Encoding', '')
+    encoding = None
+    if len(data) >= min_size:
+        if 'gzip' in accepted:
+            data, encoding = gzip.compress(data, compresslevel=5), 'gzip'
+        elif 'deflate' in accepted:
+            data, encoding = zlib.compress(data, 5), 'deflate'
+
+    response = Response(data, mimetype=mimetype)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
+    return response
+
+def admission_limits(pool):
+    """Return the admission limits of a pool from the settings."""
+    if pool == 'download':
+        # Downloads only get a global limit, nobody is ever singled out
+        return {
+            'concurrency': settings.get_setting('DOWNLOAD_CONCURRENCY'),
+            'queue_timeout': settings.get_setting('ADMISSION_QUEUE_TIMEOUT'),
+        }
+    return {
+        'concurrency': settings.get_setting('SEARCH_CONCURRENCY'),
+        'reserved': settings.get_setting('SEARCH_LOCAL_RESERVED'),
+        'peer_concurrency': settings.get_setting('SEARCH_PEER_CONCURRENCY'),
+        'peer_rate': settings.get_setting('SEARCH_PEER_RATE'),
+        'peer_burst': settings.get_setting('SEARCH_PEER_BURST'),
+        'rate': settings.get_setting('SEARCH_GLOBAL_RATE'),
+        'burst': settings.get_setting('SEARCH_GLOBAL_BURST'),
+        'queue_timeout': settings.get_setting('ADMISSION_QUEUE_TIMEOUT'),
+    }
+
+def admitted(pool, federated=False):
+    """
+    Decorate a view so it only runs once admission control lets the request in.
+
+    The slot is held until the response is fully sent, so streamed results and
+    file transfers count for as long as they last. Overloaded requests get a
+    429 with Retry-After.
+
+    Args:
+        pool (str): 'search' or 'download'.
+        federated (bool): True for endpoints called by other nodes, which are
+            limited per peer and served after local users.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # remote_addr is the forwarded client address when TRUSTED_PROXY_COUNT is set
+            client = request.remote_addr if federated else None
+            allowed, retry_after = admission.acquire(pool, admission_limits(pool), client, federated)
+            if not allowed:
+                response = jsonify({"error": "Too many requests, try again later"})
+                response.status_code = 429
+                response.headers['Retry-After'] = str(retry_after)
+                return response
+
+            try:
+                response = app.make_response(view(*args, **kwargs))
+            except BaseException:
+                admission.release(pool, client)
+                raise
+            response.call_on_close(lambda: admission.release(pool, client))
+            return response
+        return wrapper
+    return decorator
+
+@app.before_request
+def record_first_request():
+    global first_request_after
+    if first_request_after is None:
+        first_request_after = time.monotonic() - STARTED_AT
+        logger.info("First request served %.3f seconds after startup", first_request_after)
+
 @app.before_request
 def check_setup():
     ssl_enabled = os.getenv("ENABLE_SSL") == "true"
@@ -66,7 +179,7 @@ def check_setup():
             url = request.url.replace("http://", "https://", 1)
             return redirect(url, code=301)
 
-    if request.path.startswith('/static') or request.endpoint in ['setup', 'login']:
+    if request.path.startswith('/static') or request.endpoint in ['setup', 'login', 'live', 'ready']:
         return
     
     if not os.path.exists(os.getenv('DB_PATH')):
@@ -120,9 +233,13 @@ def admin():
         for key in config:
             if key in request.form:
                 try:
-                    config[key] = json.loads(request.form[key])
+                    value = json.loads(request.form[key])
                 except ValueError:
-                    config[key] = request.form[key]
+                    value = request.form[key]
+                # Only changed settings are written, and every worker picks them up
+                if value != config[key]:
+                    settings.set_setting(key, value)
+                    config[key] = value
 
     return render_template('admin.html', config=config)
 
@@ -170,6 +287,7 @@ def home():
     return render_template('index.html')
 
 @app.route('/global_search', methods=['POST'])
+@admitted('search')
 def global_search_route():
     conn = create_sqlite_connection()
     query = request.form.get('query')
@@ -178,10 +296,12 @@ def global_search_route():
         category = None
     
     results = search.global_search(query, settings.get_setting("known_nodes"), settings.get_setting("NODE_ID"), conn, "name", category)
+    search.attach_sprites(results, RESULT_PREVIEW_DISPLAY_SIZE)
     
     return render_template('results.html', query=query, category=category, results=results)
 
 @app.route('/json/global_search', methods=['POST'])
+@admitted('search')
 def global_search_json():
     conn = create_sqlite_connection()
     query = request.form.get('query')
@@ -191,9 +311,10 @@ def global_search_json():
     
     results = search.global_search(query, settings.get_setting("known_nodes"), settings.get_setting("NODE_ID"), conn, "name", category)
     
-    return jsonify(results)
+    return Response(stream_json_list(results), mimetype='application/json')
 
 @app.route('/localsearch', methods=['POST'])
+@admitted('search', federated=True)
 def localsearch_endpoint():
     conn = create_sqlite_connection()
     data = request.get_json()
@@ -202,13 +323,28 @@ def localsearch_endpoint():
     search_type = data.get('search_type', 'name')
     category = data.get('category', None)
 
-    logger.debug(f"Received request for local search: search_term={search_term}, search_type={search_type}, category={category}")
+    logger.debug("Received request for local search: search_term=%s, search_type=%s, category=%s", search_term, search_type, category)
 
-    matches = search.local_search(search_term, settings.get_setting("NODE_ID"), conn, search_type, category)
+    node_id = settings.get_setting("NODE_ID")
+    query_id = data.get('query_id')
+    if query_id is not None and not search.mark_query_seen(query_id, conn):
+        # Already answered through another path of the forwarding tree
+        conn.close()
+        matches = []
+    else:
+        matches = search.local_search(search_term, node_id, conn, search_type, category)
+        if query_id is not None:
+            matches += search.forward_search(data, settings.get_setting("known_nodes"), node_id)
 
-    return jsonify(matches), 200
+    # Peers that understand the columnar format get it, everyone else the plain JSON list
+    if search.COLUMNAR_MIMETYPE in request.headers.get('Accept', ''):
+        body = json.dumps(search.encode_columnar(matches), separators=(',', ':'))
+        return compressed_response(body, search.COLUMNAR_MIMETYPE)
+
+    return compressed_response(json.dumps(matches), 'application/json')
 
 @app.route('/md5_search/<md5_hash>')
+@admitted('search')
 def md5_search(md5_hash):
     conn = None
     try:
@@ -216,52 +352,228 @@ def md5_search(md5_hash):
         results = search.global_search(md5_hash, settings.get_setting("known_nodes"), settings.get_setting("NODE_ID"), conn, "md5")
         return render_template('md5_results.html', md5_hash=md5_hash, results=results)
     except Exception as e:
-        logger.error(f"Error during MD5 search: {e}")
+        logger.error("Error during MD5 search: %s", e)
         return "An error occurred during the search."
     finally:
         if conn:
-            put_connection(conn)
+            conn.close()
 
 @app.route('/json/md5_search/<md5_hash>')
+@admitted('search')
 def md5_search_json(md5_hash):
     conn = create_sqlite_connection()
     return search.global_search(md5_hash, settings.get_setting("known_nodes"), settings.get_setting("NODE_ID"), conn, "md5")
     
+def offloaded_file_response(path):
+    """
+    Hand a file transfer to the reverse proxy in front of the node, as configured by DOWNLOAD_OFFLOAD.
+
+    - "nginx": X-Accel-Redirect to DOWNLOAD_OFFLOAD_PREFIX plus the path relative to SHARED_DIRECTORY,
+      which nginx must map to SHARED_DIRECTORY in an internal location.
+    - "sendfile": X-Sendfile with the absolute path, for lighttpd and Apache mod_xsendfile.
+
+    The proxy then handles ranges and conditional requests, so the worker is free as soon as the headers are sent.
+
+    Returns:
+        Response: The offload response, or None to send the file from Python.
+    """
+    mode = os.getenv("DOWNLOAD_OFFLOAD")
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    if mode == "nginx":
+        shared_directory = os.path.realpath(os.getenv("SHARED_DIRECTORY"))
+        real_path = os.path.realpath(path)
+        if os.path.commonpath([shared_directory, real_path]) != shared_directory:
+            # Indexed from outside the shared directory, nginx can't reach it
+            return None
+        prefix = os.getenv("DOWNLOAD_OFFLOAD_PREFIX", "/protected-files/")
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = quote(prefix + os.path.relpath(real_path, shared_directory))
+        return response
+
+    if mode == "sendfile":
+        response = Response(mimetype=mimetype)
+        response.headers['X-Sendfile'] = os.path.realpath(path)
+        return response
+
+    return None
+
+def resolve_swarm_manifest(md5_hash):
+    """Build the swarm manifest of a file on a connection of its own, closed once it is built."""
+    conn = create_sqlite_connection()
+    try:
+        return swarm.build_manifest(md5_hash, settings.get_setting("known_nodes"), settings.get_setting("NODE_ID"),
+                                    conn, settings.get_setting("SWARM_CHUNK_SIZE"))
+    finally:
+        conn.close()
+
 @app.route('/download/<md5_hash>')
+@admitted('download')
 def download_file(md5_hash):
-    conn = create_sqlite_connection()
-    cursor = conn.cursor()
+    conn = None
     
     try:
-        # Select the file path based on the provided md5_hash
-        select_query = """
-        SELECT path FROM files WHERE md5_hash = %s;
-        """
-        cursor.execute(select_query, (md5_hash,))
-        result = cursor.fetchone()
+        # The in-memory catalog resolves most downloads without opening the database
+        entry = md5_catalog.lookup(md5_hash) if settings.get_setting("MEMORY_CATALOG") else None
+        if entry:
+            result = (entry['path'],)
+        else:
+            conn = create_sqlite_connection()
+            # Select the file path based on the provided md5_hash
+            select_query = """
+            SELECT path FROM files WHERE md5_hash = ?;
+            """
+            result = conn.execute(select_query, (md5_hash,)).fetchone()
         
         if result:
             path = result[0]
-            
-            # Increment the download_count for the specific file
-            update_query = """
-            UPDATE files SET download_count = download_count + 1 WHERE md5_hash = %s;
-            """
-            cursor.execute(update_query, (md5_hash,))
-            conn.commit()  # Commit the update
-            
-            return send_file(path)
-        else:
-            abort(404, description="File not found")
+
+            # Count a download once: not for revalidations, nor for resumed or seeking range requests
+            new_download = not request.if_none_match.contains(md5_hash) and (
+                request.range is None or request.range.ranges[0][0] == 0
+            )
+
+            response = offloaded_file_response(path)
+            if response is None:
+                # Content is addressed by md5, so the hash is a strong validator and the response never changes.
+                # conditional=True answers If-None-Match/If-Modified-Since with 304 and Range with 206.
+                # The file body goes out through wsgi.file_wrapper, which gunicorn sends with sendfile().
+                response = send_file(path, etag=md5_hash, conditional=True)
+            response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+
+            if new_download:
+                # Increment the download_count for the specific file
+                update_query = """
+                UPDATE files SET download_count = download_count + 1 WHERE md5_hash = ?;
+                """
+                conn = conn or create_sqlite_connection()
+                conn.execute(update_query, (md5_hash,))
+                conn.commit()  # Commit the update
+
+            return response
+
+        # Not hosted here: with swarm=1, assemble the file from byte ranges of every node hosting it
+        if request.args.get('swarm') == '1':
+            manifest = resolve_swarm_manifest(md5_hash)
+            if manifest:
+                response = Response(stream_with_context(swarm.stream_file(manifest, settings.get_setting("SWARM_PARALLEL"))),
+                                    mimetype=mimetypes.guess_type(manifest['file_name'])[0] or 'application/octet-stream')
+                response.headers['Content-Length'] = str(manifest['file_size'])
+                response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(manifest['file_name'])}"
+                return response
+
+        # Otherwise hand the client to a node whose md5 filter contains the hash.
+        # Redirected requests carry resolve=0 so a false positive can't bounce around the network.
+        if request.args.get('resolve') != '0':
+            node_id = settings.get_setting("NODE_ID")
+            other_nodes = [node for node in settings.get_setting("known_nodes") if node and node != node_id]
+            conn = conn or create_sqlite_connection()
+            matched, _ = bloom.candidate_nodes(md5_hash, other_nodes, conn, search.filter_max_age())
+            # Filters can give false positives, so confirm with a hedged lookup across the matches
+            host = search.hedged_md5_lookup(md5_hash, matched) if matched else None
+            if host:
+                logger.debug("Resolved download of %s to %s", md5_hash, host)
+                return redirect(f"http://{host}/download/{md5_hash}?resolve=0")
+
+        abort(404, description="File not found")
     
     finally:
-        cursor.close()
+        if conn is not None:
+            conn.close()
+
+@app.route('/chunks/<md5_hash>')
+def chunk_hashes(md5_hash):
+    """
+    Return the chunk size, SHA-256 chunk hashes and Merkle root of a file hosted on this node,
+    so downloaders can verify and retry individual chunks.
+    """
+    conn = create_sqlite_connection()
+    try:
+        hashes = indexer.get_chunk_hashes(md5_hash, conn)
+    finally:
         conn.close()
+    if hashes is None:
+        abort(404, description="No chunk hashes for this file")
+    return jsonify(hashes)
+
+@app.route('/swarm/<md5_hash>')
+@admitted('download')
+def swarm_manifest(md5_hash):
+    """
+    Return the swarm manifest of a file: every node hosting it and the byte ranges to fetch,
+    for downloaders that fetch the chunks in parallel themselves.
+    """
+    manifest = resolve_swarm_manifest(md5_hash)
+    if manifest is None:
+        abort(404, description="File not found")
+    return jsonify(manifest)
+
+@app.route('/catalog', methods=['GET'])
+def catalog_export():
+    """
+    Export the files changed after the `since` sequence number, for peers replicating this node's catalog.
+    """
+    since = request.args.get('since', 0, type=int)
+    limit = min(request.args.get('limit', 5000, type=int), 50000)
+    conn = create_sqlite_connection()
+    try:
+        page = catalog.export_catalog(conn, since, limit)
+    finally:
+        conn.close()
+
+    page['node_id'] = settings.get_setting("NODE_ID")
+    page['protocol'] = search.local_protocol()
+    return compressed_response(json.dumps(page, separators=(',', ':')), 'application/json')
+
+@app.route('/md5_filter', methods=['GET'])
+def md5_filter():
+    """
+    Serve the Bloom filter of the md5 hashes hosted on this node.
+
+    Peers cache it to send md5 lookups and downloads only to nodes that may have the file.
+    """
+    node_id = settings.get_setting("NODE_ID")
+    conn = create_sqlite_connection()
+    try:
+        blob = bloom.get_filter_blob(node_id, conn)
+    finally:
+        conn.close()
+
+    if blob is None:
+        blob = bloom.refresh_local_filter(node_id, settings.get_setting("BLOOM_ERROR_RATE"))
+
+    return Response(blob, mimetype='application/octet-stream')
 
 @app.route('/json/nodes')
 def nodes():
     return jsonify(list(settings.get_setting("known_nodes")))
 
+@app.route('/json/node_health')
+def node_health():
+    """
+    Report latency, error rate, result yield and circuit state of every node this worker has queried,
+    with the last heartbeat results of each.
+    """
+    conn = create_sqlite_connection()
+    try:
+        liveness = peer_discovery.get_liveness(conn)
+    finally:
+        conn.close()
+
+    table = peer_health.health_table()
+    for row in table:
+        row.update(liveness.get(row['node_id'], {}))
+    return jsonify(table)
+
+@app.route('/json/jobs')
+def jobs():
+    """
+    Report the state of every background job: last run, last duration, last error and next run.
+
+    Jobs only run in the leader process, so other workers report an empty list.
+    """
+    return jsonify({"leader": leader.is_leader(), "pid": os.getpid(), "jobs": job_table()})
+
 @app.route('/total_file_size', methods=['GET'])
 def total_file_size():
     connection = create_sqlite_connection()
@@ -276,6 +588,22 @@ def total_file_size():
     finally:
         connection.close()
 
+@app.route('/json/category_counts', methods=['GET'])
+def category_counts():
+    """Return the number of files hosted on this node per category."""
+    counts = md5_catalog.category_counts() if settings.get_setting("MEMORY_CATALOG") else None
+    if counts is not None:
+        return jsonify(counts)
+
+    connection = create_sqlite_connection()
+    try:
+        rows = connection.execute("SELECT COALESCE(category, 'other'), COUNT(DISTINCT md5_hash) FROM files GROUP BY 1;")
+        return jsonify(dict(rows.fetchall()))
+    except sqlite3.Error as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        connection.close()
+
 @app.route('/preview/<path:filename>', methods=['GET'])
 def serve_preview(filename):
     """
@@ -284,6 +612,9 @@ def serve_preview(filename):
     Args:
         filename (str): The name of the file whose preview is requested.
 
+    Query Parameters:
+        size (int, optional): One of previews.PREVIEW_SIZES, defaults to the largest.
+
     Returns:
         Response: The preview image file if found, otherwise a 404 error.
     """
@@ -292,20 +623,66 @@ def serve_preview(filename):
         shared_directory = os.getenv("SHARED_DIRECTORY")
         hidden_directory = os.path.join(shared_directory, '.previews')
 
-        # Construct the full path to the preview file
-        preview_file_path = os.path.join(hidden_directory, f"{filename}")
+        # Construct the full path to the preview file, refusing names that escape the previews directory
+        preview_file_path = safe_join(hidden_directory, filename)
+        size = request.args.get('size', previews.PREVIEW_SIZES[-1], type=int)
+        if preview_file_path is None or size not in previews.PREVIEW_SIZES:
+            abort(404)
+        preview_file_path = previews.sized_preview_path(preview_file_path, size)
 
         # Check if the file exists
         if not os.path.exists(preview_file_path):
-            logger.warning(f"Preview file not found: {preview_file_path}")
+            logger.warning("Preview file not found: %s", preview_file_path)
             abort(404)  # Return a 404 error if the file does not exist
 
-        # Serve the file
-        return send_file(preview_file_path, mimetype='image/webp')
+        # Serve the file. Previews are named by md5 and size, so that name is a strong ETag and they never change
+        etag = os.path.splitext(os.path.basename(preview_file_path))[0]
+        response = send_file(preview_file_path, mimetype='image/webp', etag=etag, conditional=True)
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return response
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error serving preview for {filename}: {e}")
+        logger.error("Error serving preview for %s: %s", filename, e)
         abort(500)
 
+@app.route('/preview_sprite', methods=['GET'])
+def serve_preview_sprite():
+    """
+    Serve many previews in one sprite sheet.
+
+    Query Parameters:
+        md5 (str): Comma separated md5 hashes, at most search.SPRITE_MAX of them.
+        size (int, optional): One of previews.PREVIEW_SIZES, defaults to the largest.
+
+    Returns:
+        Response: A WEBP sprite sheet laid out as described in previews.build_sprite.
+    """
+    md5_hashes = [md5_hash for md5_hash in request.args.get('md5', '').split(',') if md5_hash]
+    size = request.args.get('size', previews.PREVIEW_SIZES[-1], type=int)
+    if (not md5_hashes or len(md5_hashes) > search.SPRITE_MAX or size not in previews.PREVIEW_SIZES
+            or not all(MD5_PATTERN.fullmatch(md5_hash) for md5_hash in md5_hashes)):
+        abort(400)
+
+    hidden_directory = os.path.join(os.getenv("SHARED_DIRECTORY"), '.previews')
+    preview_files = [
+        previews.sized_preview_path(os.path.join(hidden_directory, search.preview_name(md5_hash)), size)
+        for md5_hash in md5_hashes
+    ]
+
+    # Previews never change once generated, so the sheet only changes when one appears
+    present = ''.join('1' if os.path.exists(preview_file) else '0' for preview_file in preview_files)
+    etag = hashlib.md5(f"{size}:{','.join(md5_hashes)}:{present}".encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        buffer = io.BytesIO()
+        previews.build_sprite(preview_files, size).save(buffer, "WEBP")
+        response = Response(buffer.getvalue(), mimetype='image/webp')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
 @app.route('/announce', methods=['POST'])
 def announce_endpoint():
     """
@@ -313,16 +690,34 @@ def announce_endpoint():
     """
     data = request.json
     node_id = data.get("node_id")
-    response_url = data.get("response_url")
     received_known_nodes = data.get("known_nodes", [])
-    logger.debug(f"Handling Announcement From {node_id}")
+    logger.debug("Handling Announcement From %s", node_id)
+    settings.update_known_nodes(added=[node_id, *received_known_nodes])
     known_nodes = settings.get_setting("known_nodes")
-    known_nodes.add(node_id)
-    known_nodes.add(received_known_nodes)
-    settings.set_setting("known_nodes", known_nodes)
+
+    conn = create_sqlite_connection()
+    try:
+        peer_discovery.add_seed_nodes(known_nodes - {settings.get_setting("NODE_ID")}, conn)
+    finally:
+        conn.close()
 
     return jsonify({"known_nodes": list(known_nodes)}), 200
 
+@app.route('/gossip', methods=['POST'])
+def gossip_endpoint():
+    """
+    Endpoint for membership gossip: merge the peer's membership changes and answer with ours.
+    """
+    data = request.get_json(silent=True)
+    if not data or not data.get("node_id"):
+        return jsonify({"error": "node_id is required"}), 400
+
+    conn = create_sqlite_connection()
+    try:
+        return jsonify(peer_discovery.handle_gossip(data, conn, settings.get_setting("NODE_ID"))), 200
+    finally:
+        conn.close()
+
 @app.route('/heartbeat', methods=['GET'])
 def heartbeat():
     """
@@ -332,8 +727,47 @@ def heartbeat():
     """
     return jsonify({"status": "alive", "message": "Heartbeat response from the node"}), 200
 
-start_scheduler()
-schedule_tasks()
+@app.route('/live')
+def live():
+    """
+    Liveness probe: the worker is up and answering.
+    """
+    return jsonify({
+        "status": "alive",
+        "pid": os.getpid(),
+        "uptime": time.monotonic() - STARTED_AT,
+        "first_request_after": first_request_after,
+        "admission": admission.admission_table(),
+    }), 200
+
+@app.route('/ready')
+def ready():
+    """
+    Readiness probe: the index can be queried, so local searches and downloads work.
+
+    Indexing, bootstrap and discovery keep warming up in the background;
+    their progress is reported but doesn't hold readiness back.
+    """
+    try:
+        conn = create_sqlite_connection()
+        try:
+            conn.execute("SELECT 1 FROM files LIMIT 1;").fetchall()
+            warmup = warmup_status(conn)
+        finally:
+            conn.close()
+    except Exception as e:
+        logger.error("Readiness check failed: %s", e)
+        return jsonify({"status": "unavailable", "error": str(e)}), 503
+
+    return jsonify({"status": "ready", "warmup": warmup}), 200
+
+def start_background_jobs():
+    # Register every job before the scheduler starts, so warm-up tracking covers all of them
+    schedule_tasks()
+    start_scheduler()
+
+# Only the gunicorn worker holding the lock runs background jobs, the others just serve requests
+leader.start_election(start_background_jobs)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.getenv("NODE_PORT", 5000)))
@@ -0,0 +1,145 @@
+import math
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Token buckets idle for this many seconds are forgotten, keeping the table bounded
+BUCKET_IDLE_TIMEOUT = 600
+MAX_BUCKETS = 10000
+
+_cond = threading.Condition()
+# Per pool: requests being served, local requests waiting for a slot, and rejections
+_pools = {}
+# Requests being served per (pool, client)
+_client_in_flight = {}
+# Token buckets, keyed by (pool, client) or (pool, None) for the pool-wide one: [tokens, updated_at]
+_buckets = {}
+
+def _pool(name):
+    """Return the state of a pool, creating it if needed. Caller must hold _cond."""
+    pool = _pools.get(name)
+    if pool is None:
+        pool = {'in_flight': 0, 'waiting_local': 0, 'rejected': 0}
+        _pools[name] = pool
+    return pool
+
+def _refill(key, rate, burst, now):
+    """
+    Refill a bucket at `rate` tokens per second, holding at most `burst`, and return its tokens.
+
+    Caller must hold _cond.
+    """
+    tokens, updated_at = _buckets.get(key, (burst, now))
+    tokens = min(burst, tokens + (now - updated_at) * rate)
+    _buckets[key] = (tokens, now)
+    return tokens
+
+def _prune_buckets(now):
+    """Drop buckets idle long enough to be full again. Caller must hold _cond."""
+    if len(_buckets) < MAX_BUCKETS:
+        return
+    for key in [key for key, (_, updated_at) in _buckets.items() if now - updated_at > BUCKET_IDLE_TIMEOUT]:
+        del _buckets[key]
+
+def _can_enter(name, pool, limits, client, federated):
+    """Check whether a request may take a slot now. Caller must hold _cond."""
+    concurrency = limits.get('concurrency')
+    if not concurrency:
+        return True
+    if not federated:
+        return pool['in_flight'] < concurrency
+
+    # Federated requests never use the slots reserved for local users, and wait while a local user does
+    if pool['in_flight'] >= concurrency - limits.get('reserved', 0) or pool['waiting_local']:
+        return False
+    peer_concurrency = limits.get('peer_concurrency')
+    return not peer_concurrency or _client_in_flight.get((name, client), 0) < peer_concurrency
+
+def acquire(name, limits, client=None, federated=False):
+    """
+    Admit a request into a pool, waiting up to the queue timeout for a free slot.
+
+    Federated requests (from other nodes) go through a per-client and a pool-wide
+    token bucket, are limited in concurrency per client, and only get the slots
+    not reserved for local users. Local requests skip the buckets and are
+    admitted before any waiting federated request.
+
+    Args:
+        name (str): The pool, e.g. 'search' or 'download'.
+        limits (dict): 'concurrency' (0 or None for unlimited), 'queue_timeout' and, for
+            federated requests, 'reserved', 'peer_concurrency', 'peer_rate', 'peer_burst',
+            'rate' and 'burst'.
+        client (str): Address of the client, for per-client limits.
+        federated (bool): True for requests from other nodes.
+
+    Returns:
+        tuple: (admitted, retry_after) where retry_after is the number of seconds the
+        client should wait before trying again when not admitted.
+    """
+    queue_timeout = limits.get('queue_timeout', 0)
+    now = time.monotonic()
+    with _cond:
+        pool = _pool(name)
+
+        if federated:
+            _prune_buckets(now)
+            buckets = []
+            if limits.get('peer_rate'):
+                buckets.append(((name, client), limits['peer_rate'], limits.get('peer_burst', 1)))
+            if limits.get('rate'):
+                buckets.append(((name, None), limits['rate'], limits.get('burst', 1)))
+
+            # Tokens are only taken when every bucket has one, so an empty pool-wide
+            # bucket doesn't also drain the peer's own budget
+            wait = 0
+            for key, rate, burst in buckets:
+                tokens = _refill(key, rate, burst, now)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+            if wait:
+                pool['rejected'] += 1
+                logger.warning("Rate limit reached for %s requests from %s", name, client)
+                return False, math.ceil(wait)
+            for key, _, _ in buckets:
+                _buckets[key] = (_buckets[key][0] - 1, now)
+
+        deadline = now + queue_timeout
+        if not federated:
+            pool['waiting_local'] += 1
+        try:
+            while not _can_enter(name, pool, limits, client, federated):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    pool['rejected'] += 1
+                    logger.warning("No free %s slot within %ss, rejecting request from %s", name, queue_timeout, client or 'local user')
+                    return False, max(math.ceil(queue_timeout), 1)
+                _cond.wait(remaining)
+        finally:
+            if not federated:
+                pool['waiting_local'] -= 1
+
+        pool['in_flight'] += 1
+        if client is not None:
+            _client_in_flight[(name, client)] = _client_in_flight.get((name, client), 0) + 1
+    return True, 0
+
+def release(name, client=None):
+    """Free the slot taken by acquire() and wake up waiting requests."""
+    with _cond:
+        _pools[name]['in_flight'] -= 1
+        if client is not None:
+            key = (name, client)
+            _client_in_flight[key] -= 1
+            if not _client_in_flight[key]:
+                del _client_in_flight[key]
+        _cond.notify_all()
+
+def admission_table():
+    """Return the state of every pool: requests in flight, local requests waiting and rejections."""
+    with _cond:
+        return {
+            name: {'in_flight': pool['in_flight'], 'waiting_local': pool['waiting_local'], 'rejected': pool['rejected']}
+            for name, pool in _pools.items()
+        }
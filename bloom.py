@@ -0,0 +1,181 @@
+import math
+import time
+import struct
+import logging
+import requests
+from database import create_sqlite_connection
+
+logger = logging.getLogger(__name__)
+
+# Serialized filter layout: number of bits (uint32), number of hashes (uint8), bit array
+_HEADER = struct.Struct(">IB")
+
+# Deserialized peer filters, keyed by node_id: (updated_at, filter)
+_filter_cache = {}
+
+def new_filter(capacity, error_rate=0.01):
+    """
+    Create an empty Bloom filter sized for the given capacity and false positive rate.
+
+    Args:
+        capacity (int): Expected number of md5 hashes in the filter.
+        error_rate (float): Target false positive probability.
+
+    Returns:
+        dict: The filter, with 'm' (bits), 'k' (hash count) and 'bits' (bytearray).
+    """
+    capacity = max(int(capacity), 1)
+    m = max(int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))), 8)
+    k = min(max(int(round(m / capacity * math.log(2))), 1), 255)
+    return {'m': m, 'k': k, 'bits': bytearray((m + 7) // 8)}
+
+def _positions(bloom, md5_hash):
+    """
+    Yield the bit positions of an md5 hash.
+
+    The md5 digest is already uniformly distributed, so its two halves are used
+    directly for double hashing instead of rehashing the value k times.
+    """
+    digest = bytes.fromhex(md5_hash)
+    h1 = int.from_bytes(digest[:8], "big")
+    h2 = int.from_bytes(digest[8:], "big") | 1
+    for i in range(bloom['k']):
+        yield (h1 + i * h2) % bloom['m']
+
+def add(bloom, md5_hash):
+    """Add an md5 hash to the filter."""
+    for pos in _positions(bloom, md5_hash):
+        bloom['bits'][pos >> 3] |= 1 << (pos & 7)
+
+def might_contain(bloom, md5_hash):
+    """Return False if the md5 hash is definitely not in the filter, True if it may be."""
+    try:
+        return all(bloom['bits'][pos >> 3] & (1 << (pos & 7)) for pos in _positions(bloom, md5_hash))
+    except ValueError:
+        # Not a valid md5 hex digest, so it can't be in anyone's index
+        return False
+
+def serialize(bloom):
+    """Serialize a filter to bytes for storage or transfer."""
+    return _HEADER.pack(bloom['m'], bloom['k']) + bytes(bloom['bits'])
+
+def deserialize(blob):
+    """Rebuild a filter from bytes produced by serialize()."""
+    m, k = _HEADER.unpack_from(blob)
+    bits = bytearray(blob[_HEADER.size:])
+    if len(bits) != (m + 7) // 8 or k == 0:
+        raise ValueError("Malformed Bloom filter")
+    return {'m': m, 'k': k, 'bits': bits}
+
+def build_local_filter(conn, error_rate=0.01):
+    """
+    Build a Bloom filter of every md5 hash in the local index.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the local index.
+        error_rate (float): Target false positive probability.
+
+    Returns:
+        dict: The populated filter.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT COUNT(DISTINCT md5_hash) FROM files;")
+        bloom = new_filter(cursor.fetchone()[0], error_rate)
+        cursor.execute("SELECT DISTINCT md5_hash FROM files;")
+        for (md5_hash,) in cursor:
+            add(bloom, md5_hash)
+    finally:
+        cursor.close()
+    return bloom
+
+def store_filter(node_id, blob, conn):
+    """Store a serialized filter for a node, replacing any previous one."""
+    conn.execute(
+        "INSERT OR REPLACE INTO peer_filters (node_id, filter, updated_at) VALUES (?, ?, ?);",
+        (node_id, blob, time.time())
+    )
+    conn.commit()
+
+def get_filter_blob(node_id, conn):
+    """Return the stored serialized filter of a node, or None if there is none."""
+    row = conn.execute("SELECT filter FROM peer_filters WHERE node_id = ?;", (node_id,)).fetchone()
+    return row[0] if row else None
+
+def refresh_local_filter(node_id, error_rate=0.01):
+    """Rebuild this node's filter from the index and store it for the /md5_filter endpoint."""
+    conn = create_sqlite_connection()
+    try:
+        blob = serialize(build_local_filter(conn, error_rate))
+        store_filter(node_id, blob, conn)
+        logger.info("Local md5 filter refreshed (%s bytes)", len(blob))
+        return blob
+    finally:
+        conn.close()
+
+def fetch_peer_filters(known_nodes, node_id, timeout=10):
+    """
+    Download the md5 filter of every known node and cache it locally.
+
+    Nodes that do not serve a filter are left without one, so they keep
+    receiving every md5 lookup.
+
+    Args:
+        known_nodes (set): Nodes to fetch filters from.
+        node_id (str): The ID of the current node, which is skipped.
+        timeout (int): Timeout for each request in seconds.
+    """
+    conn = create_sqlite_connection()
+    try:
+        for node in known_nodes:
+            if not node or node == node_id:
+                continue
+            try:
+                response = requests.get(f"http://{node}/md5_filter", timeout=timeout)
+                response.raise_for_status()
+                deserialize(response.content)
+                store_filter(node, response.content, conn)
+                logger.debug("Cached md5 filter of %s (%s bytes)", node, len(response.content))
+            except (requests.RequestException, ValueError, struct.error) as e:
+                logger.warning("Could not fetch md5 filter from %s: %s", node, e)
+    finally:
+        conn.close()
+
+def candidate_nodes(md5_hash, known_nodes, conn, max_age):
+    """
+    Select the nodes that may hold an md5 hash.
+
+    Args:
+        md5_hash (str): The md5 hash being looked up.
+        known_nodes (iterable): Nodes to choose from.
+        conn (sqlite3.Connection): Connection to the local index.
+        max_age (float): Filters older than this many seconds are ignored.
+
+    Returns:
+        tuple: (matched, unknown) lists of node IDs; matched nodes have a fresh
+        filter containing the hash, unknown nodes have no usable filter.
+    """
+    rows = conn.execute("SELECT node_id, updated_at FROM peer_filters;").fetchall()
+    updated = dict(rows)
+    now = time.time()
+    matched, unknown = [], []
+
+    for node in known_nodes:
+        updated_at = updated.get(node)
+        if updated_at is None or now - updated_at > max_age:
+            unknown.append(node)
+            continue
+
+        cached = _filter_cache.get(node)
+        if cached is None or cached[0] != updated_at:
+            try:
+                cached = (updated_at, deserialize(get_filter_blob(node, conn)))
+            except (ValueError, TypeError, struct.error):
+                unknown.append(node)
+                continue
+            _filter_cache[node] = cached
+
+        if might_contain(cached[1], md5_hash):
+            matched.append(node)
+
+    return matched, unknown
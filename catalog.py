@@ -0,0 +1,119 @@
+import time
+import logging
+import requests
+from database import create_sqlite_connection
+
+logger = logging.getLogger(__name__)
+
+CATALOG_COLUMNS = ('md5_hash', 'file_name', 'file_size', 'category', 'download_count', 'seq')
+
+def export_catalog(conn, since=0, limit=5000):
+    """
+    Export the files changed after a sequence number, in columnar form.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the local index.
+        since (int): Only files with a higher sequence number are exported.
+        limit (int): Maximum number of files in one page.
+
+    Returns:
+        dict: 'columns' with one list per catalog column, 'last_seq' to pass as
+        `since` for the next page, and 'more' telling whether another page follows.
+    """
+    rows = conn.execute(
+        f"SELECT {', '.join(CATALOG_COLUMNS)} FROM files WHERE seq > ? ORDER BY seq LIMIT ?;",
+        (since, limit + 1)
+    ).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    columns = {name: [row[i] for row in rows] for i, name in enumerate(CATALOG_COLUMNS)}
+    return {
+        'columns': columns,
+        'last_seq': rows[-1][-1] if rows else since,
+        'more': more,
+    }
+
+def sync_node(node, conn, page_size=5000, timeout=30):
+    """
+    Pull the catalog changes of a node into the local replica.
+
+    Only files changed since the last synced sequence number are transferred,
+    one page at a time, each page applied in a single transaction.
+
+    Args:
+        node (str): The node to sync from.
+        conn (sqlite3.Connection): Connection to the local index.
+        page_size (int): Files requested per page.
+        timeout (int): Timeout for each request in seconds.
+
+    Returns:
+        int: Number of replica rows added or updated.
+    """
+    row = conn.execute("SELECT last_seq FROM replica_state WHERE node_id = ?;", (node,)).fetchone()
+    since = row[0] if row else 0
+    synced = 0
+
+    while True:
+        response = requests.get(
+            f"http://{node}/catalog",
+            params={"since": since, "limit": page_size},
+            headers={"Accept-Encoding": "gzip, deflate"},
+            timeout=timeout
+        )
+        response.raise_for_status()
+        page = response.json()
+        columns = page['columns']
+
+        with conn:
+            conn.executemany(
+                """
+                INSERT OR REPLACE INTO replica_files
+                (node_id, md5_hash, file_name, file_size, category, download_count, seq)
+                VALUES (?, ?, ?, ?, ?, ?, ?);
+                """,
+                ((node, *values) for values in zip(*(columns[name] for name in CATALOG_COLUMNS)))
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO replica_state (node_id, protocol, last_seq, synced_at) VALUES (?, ?, ?, ?);",
+                (node, page.get('protocol', 'http'), page['last_seq'], time.time())
+            )
+
+        synced += len(columns['md5_hash'])
+        since = page['last_seq']
+        if not page['more']:
+            return synced
+
+def sync_catalogs(known_nodes, node_id):
+    """
+    Sync the local replica with the catalog of every known node.
+
+    Args:
+        known_nodes (set): Nodes to sync from.
+        node_id (str): The ID of the current node, which is skipped.
+    """
+    conn = create_sqlite_connection()
+    try:
+        for node in known_nodes:
+            if not node or node == node_id:
+                continue
+            try:
+                synced = sync_node(node, conn)
+                logger.info("Synced %s catalog changes from %s", synced, node)
+            except (requests.RequestException, ValueError, KeyError) as e:
+                logger.warning("Catalog sync from %s failed: %s", node, e)
+    finally:
+        conn.close()
+
+def fresh_replicas(conn, max_age):
+    """
+    Return the nodes whose replica was synced recently enough to answer searches locally.
+
+    Returns:
+        dict: Protocol of each fresh node, keyed by node_id.
+    """
+    rows = conn.execute(
+        "SELECT node_id, protocol FROM replica_state WHERE synced_at >= ?;",
+        (time.time() - max_age,)
+    ).fetchall()
+    return dict(rows)
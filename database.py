@@ -2,25 +2,8 @@ import os
 import sqlite3
 import time
 import logging
-from colorlog import ColoredFormatter
 
-log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-formatter = ColoredFormatter(
-    "%(asctime)s - %(name)s - %(log_color)s%(levelname)s%(reset)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    log_colors={
-        'DEBUG': 'cyan',
-        'INFO': 'green',
-        'WARNING': 'yellow',
-        'ERROR': 'red',
-        'CRITICAL': 'bold_red',
-    }
-)
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(formatter)
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-logger.addHandler(console_handler)
+logger = logging.getLogger(__name__)
 
 DB_PATH = os.getenv("DB_PATH", "index.sqlite")
 
@@ -33,12 +16,12 @@ def create_sqlite_connection():
     while attempt < max_attempts:
         try:
             conn = sqlite3.connect(DB_PATH)
-            logger.info("Successfully connected to SQLite database.")
+            logger.debug("Successfully connected to SQLite database.")
             return conn
         except sqlite3.Error as e:
             attempt += 1
-            logger.warning(f"Attempt {attempt} failed. Retrying in {backoff_time} seconds...")
-            logger.error(f"Error: {e}")
+            logger.warning("Attempt %s failed. Retrying in %s seconds...", attempt, backoff_time)
+            logger.error("Error: %s", e)
             time.sleep(backoff_time)
             backoff_time *= 2
 
@@ -50,31 +33,148 @@ def execute_query(query, params=None):
         cursor = conn.cursor()
         cursor.execute(query, params or ())
         conn.commit()
-        logger.info("Query executed successfully.")
+        logger.debug("Query executed successfully.")
         return cursor.fetchall()
     except sqlite3.Error as e:
-        logger.error(f"Query execution failed: {e}")
+        logger.error("Query execution failed: %s", e)
         raise
     finally:
         conn.close()
-        logger.info("SQLite connection closed.")
+        logger.debug("SQLite connection closed.")
+
+def _add_column_if_missing(cursor, table, column, declaration):
+    """Add a column to an existing table unless it is already there."""
+    cursor.execute(f"PRAGMA table_info({table});")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration};")
+        logger.info("Added column %s to %s", column, table)
 
 def init_db():
     conn = create_sqlite_connection()
     try:
         cursor = conn.cursor()
+        # Readers don't block the writer, every gunicorn worker shares this database
+        cursor.execute("PRAGMA journal_mode=WAL;")
         cursor.executescript("""
             CREATE TABLE IF NOT EXISTS files (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 md5_hash TEXT NOT NULL,
                 path TEXT NOT NULL,
                 download_count INTEGER DEFAULT 0,
-                file_size INTEGER
+                file_size INTEGER,
+                file_name TEXT,
+                category TEXT,
+                seq INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS peer_filters (
+                node_id TEXT PRIMARY KEY,
+                filter BLOB NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS seen_queries (
+                query_id TEXT PRIMARY KEY,
+                seen_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS file_chunks (
+                md5_hash TEXT PRIMARY KEY,
+                chunk_size INTEGER NOT NULL,
+                merkle_root TEXT NOT NULL,
+                hashes BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS archive_members (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                archive_md5 TEXT NOT NULL,
+                member_name TEXT NOT NULL,
+                member_size INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS archive_members_md5 ON archive_members (archive_md5);
+            CREATE TABLE IF NOT EXISTS node_liveness (
+                node_id TEXT PRIMARY KEY,
+                last_seen REAL,
+                last_checked REAL NOT NULL,
+                failures INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS members (
+                node_id TEXT PRIMARY KEY,
+                incarnation INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                seq INTEGER,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS gossip_peers (
+                node_id TEXT PRIMARY KEY,
+                received_seq INTEGER NOT NULL DEFAULT 0,
+                sent_seq INTEGER NOT NULL DEFAULT 0,
+                mismatches INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
             );
+            CREATE TABLE IF NOT EXISTS known_nodes (
+                node_id TEXT PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS settings_meta (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO settings_meta (id, version) VALUES (1, 0);
+            CREATE TABLE IF NOT EXISTS warmup (
+                name TEXT PRIMARY KEY,
+                started_at REAL NOT NULL,
+                completed_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS replica_files (
+                node_id TEXT NOT NULL,
+                md5_hash TEXT NOT NULL,
+                file_name TEXT,
+                file_size INTEGER,
+                category TEXT,
+                download_count INTEGER DEFAULT 0,
+                seq INTEGER,
+                PRIMARY KEY (node_id, md5_hash)
+            );
+            CREATE TABLE IF NOT EXISTS replica_state (
+                node_id TEXT PRIMARY KEY,
+                protocol TEXT NOT NULL,
+                last_seq INTEGER NOT NULL,
+                synced_at REAL NOT NULL
+            );
+        """)
+        # Databases created before these columns existed
+        _add_column_if_missing(cursor, "files", "file_name", "TEXT")
+        _add_column_if_missing(cursor, "files", "category", "TEXT")
+        _add_column_if_missing(cursor, "files", "seq", "INTEGER")
+        _add_column_if_missing(cursor, "gossip_peers", "mismatches", "INTEGER NOT NULL DEFAULT 0")
+        # Rows indexed before seq existed get one too, or peers would never pull them
+        cursor.execute("UPDATE files SET seq = id WHERE seq IS NULL;")
+        # Every change to a file or member bumps its sequence number, so peers can pull just the changes
+        cursor.executescript("""
+            CREATE INDEX IF NOT EXISTS files_seq ON files (seq);
+            CREATE INDEX IF NOT EXISTS files_md5 ON files (md5_hash);
+            CREATE INDEX IF NOT EXISTS files_path ON files (path);
+            CREATE TRIGGER IF NOT EXISTS files_seq_insert AFTER INSERT ON files
+            BEGIN
+                UPDATE files SET seq = (SELECT COALESCE(MAX(seq), 0) + 1 FROM files) WHERE id = NEW.id;
+            END;
+            CREATE TRIGGER IF NOT EXISTS files_seq_update
+            AFTER UPDATE OF md5_hash, file_name, file_size, category, download_count ON files
+            BEGIN
+                UPDATE files SET seq = (SELECT COALESCE(MAX(seq), 0) + 1 FROM files) WHERE id = NEW.id;
+            END;
+            CREATE INDEX IF NOT EXISTS members_seq ON members (seq);
+            CREATE TRIGGER IF NOT EXISTS members_seq_insert AFTER INSERT ON members
+            BEGIN
+                UPDATE members SET seq = (SELECT COALESCE(MAX(seq), 0) + 1 FROM members) WHERE node_id = NEW.node_id;
+            END;
+            CREATE TRIGGER IF NOT EXISTS members_seq_update AFTER UPDATE OF incarnation, status ON members
+            BEGIN
+                UPDATE members SET seq = (SELECT COALESCE(MAX(seq), 0) + 1 FROM members) WHERE node_id = NEW.node_id;
+            END;
         """)
         conn.commit()
         logger.info("Database initialized successfully.")
     except sqlite3.Error as e:
-        logger.error(f"Error initializing database: {e}")
+        logger.error("Error initializing database: %s", e)
     finally:
         conn.close()
\ No newline at end of file
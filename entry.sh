@@ -1,11 +1,13 @@
 #!/bin/sh
 
+# Threaded workers so a slow download only holds one thread, not a whole worker
+WORKER_OPTS="--worker-class gthread --threads ${GUNICORN_THREADS:-32}"
+
 if [ "${ENABLE_SSL}" = "true" ]; then
-    gunicorn -w 4 -b 0.0.0.0:${NODE_PORT:-5000} 0din:app \
+    gunicorn -w 4 ${WORKER_OPTS} -b 0.0.0.0:${NODE_PORT:-5000} 0din:app \
         --certfile=cert.pem --keyfile=key.pem \
         --log-level debug --access-logfile - --error-logfile -
 else
-    gunicorn -w 4 -b 0.0.0.0:${NODE_PORT:-5000} 0din:app \
+    gunicorn -w 4 ${WORKER_OPTS} -b 0.0.0.0:${NODE_PORT:-5000} 0din:app \
         --log-level debug --access-logfile - --error-logfile -
 fi
-
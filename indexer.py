@@ -1,54 +1,208 @@
 import os
+import time
+import random
 import hashlib
+import itertools
+import zipfile
 import re
 import logging
-import colorlog
 from database import init_db
+from previews import iter_archive_members
 
-# Configure logger with colorlog
-logger = colorlog.getLogger(__name__)
-handler = colorlog.StreamHandler()
-handler.setFormatter(
-    colorlog.ColoredFormatter(
-        "%(log_color)s%(levelname)s:%(name)s:%(message)s",
-        log_colors={
-            "DEBUG": "cyan",
-            "INFO": "green",
-            "WARNING": "yellow",
-            "ERROR": "red",
-            "CRITICAL": "bold_red",
-        },
-    )
-)
-logger.addHandler(handler)
-logger.setLevel(logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Archives whose members are indexed, at most ARCHIVE_MAX_MEMBERS of them, and only
+# up to ARCHIVE_MAX_STREAM_SIZE bytes for tar archives that must be streamed through
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".gz", ".tgz", ".bz2", ".tbz2", ".xz", ".txz")
+ARCHIVE_MAX_MEMBERS = 10000
+ARCHIVE_MAX_STREAM_SIZE = 4 * 1024 * 1024 * 1024
+
+# Files are hashed in CHUNK_SIZE chunks for verifiable partial transfers,
+# read READ_SIZE bytes at a time (READ_SIZE must divide CHUNK_SIZE)
+CHUNK_SIZE = 4 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+def merkle_root(digests):
+    """
+    Compute the Merkle root of a list of chunk digests.
+
+    Pairs of nodes are hashed together with SHA-256 level by level; an odd node
+    out is carried up unchanged. An empty file's root is the hash of no data.
+
+    Args:
+        digests (list): Raw 32-byte SHA-256 chunk digests.
+
+    Returns:
+        str: The hex encoded root.
+    """
+    level = list(digests) or [hashlib.sha256(b"").digest()]
+    while len(level) > 1:
+        level = [
+            hashlib.sha256(level[i] + level[i + 1]).digest() if i + 1 < len(level) else level[i]
+            for i in range(0, len(level), 2)
+        ]
+    return level[0].hex()
+
+def _calculate_hashes(file_path, connection):
+    """
+    Calculate or reuse the MD5 hash of a given file.
 
-def _calculate_md5(file_path, connection):
-    """Calculate or reuse the MD5 hash of a given file."""
-    logger.debug(f"Checking MD5 for {file_path}")
+    Files that are read are also split into CHUNK_SIZE chunks in the same pass,
+    with one SHA-256 digest per chunk so partial transfers can be verified.
+
+    Returns:
+        tuple: (md5 hex digest or None on error, list of chunk digests or None if the MD5 was reused)
+    """
+    logger.debug("Checking MD5 for %s", file_path)
 
-    with connection.cursor() as cursor:
-        cursor.execute("SELECT md5_hash FROM files WHERE path = %s;", (file_path,))
-        result = cursor.fetchone()
+    cursor = connection.execute("SELECT md5_hash FROM files WHERE path = ?;", (file_path,))
+    result = cursor.fetchone()
         
     if result:
-        logger.info(f"Reusing existing MD5 for {file_path}: {result[0]}")
-        return result[0]
+        logger.debug("Reusing existing MD5 for %s: %s", file_path, result[0])
+        return result[0], None
     
-    logger.debug(f"Calculating MD5 for {file_path}")
+    logger.debug("Calculating MD5 for %s", file_path)
+    try:
+        return _hash_file(file_path)
+    except Exception as e:
+        logger.error("Error calculating MD5 for %s: %s", file_path, e)
+        return None, None
+
+def _hash_file(file_path):
+    """
+    Read a file once, computing its MD5 and the SHA-256 digest of each CHUNK_SIZE chunk.
+
+    Returns:
+        tuple: (md5 hex digest, list of raw chunk digests)
+    """
     md5_hash = hashlib.md5()
+    chunk_hash = hashlib.sha256()
+    chunk_fill = 0
+    chunk_digests = []
+    with open(file_path, "rb") as f:
+        # READ_SIZE divides CHUNK_SIZE, so reads never straddle a chunk boundary
+        for block in iter(lambda: f.read(READ_SIZE), b""):
+            md5_hash.update(block)
+            chunk_hash.update(block)
+            chunk_fill += len(block)
+            if chunk_fill == CHUNK_SIZE:
+                chunk_digests.append(chunk_hash.digest())
+                chunk_hash = hashlib.sha256()
+                chunk_fill = 0
+    if chunk_fill:
+        chunk_digests.append(chunk_hash.digest())
+    return md5_hash.hexdigest(), chunk_digests
+
+def _store_chunk_hashes(file_hash, chunk_digests, connection):
+    """Store the chunk digests of a file compactly, as one blob of concatenated 32-byte digests."""
+    connection.execute(
+        "INSERT OR REPLACE INTO file_chunks (md5_hash, chunk_size, merkle_root, hashes) VALUES (?, ?, ?, ?);",
+        (file_hash, CHUNK_SIZE, merkle_root(chunk_digests), b"".join(chunk_digests))
+    )
+
+def backfill_chunk_hashes(connection, stats):
+    """
+    Compute the chunk hashes of indexed files that have none.
+
+    Files indexed before chunk hashes existed, or imported from a manifest,
+    reuse their MD5 and were never read, so they can't be verified chunk by
+    chunk. Each is read once here; a file whose content no longer matches its
+    MD5 is left alone. Counts are added to stats.
+    """
+    rows = connection.execute("""
+        SELECT files.md5_hash, MIN(files.path) FROM files
+        LEFT JOIN file_chunks ON file_chunks.md5_hash = files.md5_hash
+        WHERE file_chunks.md5_hash IS NULL
+        GROUP BY files.md5_hash;
+    """).fetchall()
+    for file_hash, file_path in rows:
+        try:
+            actual_hash, chunk_digests = _hash_file(file_path)
+        except OSError as e:
+            logger.warning("Could not read %s for its chunk hashes: %s", file_path, e)
+            stats['errors'] += 1
+            continue
+        stats['bytes_hashed'] += os.path.getsize(file_path)
+        if actual_hash != file_hash:
+            logger.warning("%s changed since it was indexed (MD5 %s, now %s), not storing its chunk hashes",
+                           file_path, file_hash, actual_hash)
+            continue
+        with connection:
+            _store_chunk_hashes(file_hash, chunk_digests, connection)
+        stats['chunks_backfilled'] += 1
+
+def backfill_archive_members(connection, stats):
+    """
+    List the members of indexed archives that have none.
+
+    Archives indexed before member listing existed, or imported from a manifest,
+    were never listed, so their contents couldn't be searched. Each is listed
+    here, within the same bounds as newly indexed archives. Counts are added
+    to stats.
+    """
+    extension_match = " OR ".join("LOWER(files.path) LIKE ?" for _ in ARCHIVE_EXTENSIONS)
+    rows = connection.execute(f"""
+        SELECT files.md5_hash, MIN(files.path), MIN(files.file_size) FROM files
+        LEFT JOIN archive_members ON archive_members.archive_md5 = files.md5_hash
+        WHERE archive_members.archive_md5 IS NULL AND ({extension_match})
+        GROUP BY files.md5_hash;
+    """, [f"%{extension}" for extension in ARCHIVE_EXTENSIONS]).fetchall()
+    for file_hash, file_path, file_size in rows:
+        if not os.path.exists(file_path):
+            continue
+        with connection:
+            _index_archive_members(file_path, file_hash, file_size or 0, connection)
+        stats['archives_backfilled'] += 1
+
+def _index_archive_members(file_path, file_hash, file_size, connection):
+    """
+    Store the member names of an archive so they can be searched.
+
+    Work is bounded: compressed tar archives larger than ARCHIVE_MAX_STREAM_SIZE are
+    skipped since listing them means decompressing them, and at most
+    ARCHIVE_MAX_MEMBERS members are read.
+    """
+    if file_size > ARCHIVE_MAX_STREAM_SIZE and not zipfile.is_zipfile(file_path):
+        logger.info("Not listing members of %s, too large to stream", file_path)
+        return
+
     try:
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                md5_hash.update(chunk)
-        return md5_hash.hexdigest()
+        members = list(itertools.islice(iter_archive_members(file_path), ARCHIVE_MAX_MEMBERS))
     except Exception as e:
-        logger.error(f"Error calculating MD5 for {file_path}: {e}")
+        logger.warning("Could not list members of %s: %s", file_path, e)
+        return
+
+    connection.execute("DELETE FROM archive_members WHERE archive_md5 = ?;", (file_hash,))
+    connection.executemany(
+        "INSERT INTO archive_members (archive_md5, member_name, member_size) VALUES (?, ?, ?);",
+        ((file_hash, name, size) for name, size in members)
+    )
+    logger.debug("Indexed %s members of %s", len(members), file_path)
+
+def get_chunk_hashes(md5_hash, connection):
+    """
+    Return the chunk hashes of a file.
+
+    Returns:
+        dict: 'chunk_size', 'merkle_root' and 'chunks' (hex digests in file order), or None if they are unknown.
+    """
+    row = connection.execute(
+        "SELECT chunk_size, merkle_root, hashes FROM file_chunks WHERE md5_hash = ?;", (md5_hash,)
+    ).fetchone()
+    if row is None:
         return None
+    chunk_size, root, hashes = row
+    return {
+        'md5_hash': md5_hash,
+        'chunk_size': chunk_size,
+        'merkle_root': root,
+        'chunks': [hashes[i:i + 32].hex() for i in range(0, len(hashes), 32)],
+    }
 
 def _detect_category(file_path, file_extension):
     """Detect the file's category based on its path or file extension."""
-    logger.debug(f"Detecting category for {file_path}")
+    logger.debug("Detecting category for %s", file_path)
 
     categories = {
         "movie": ["movie", "movies", "film", "cinema", "flick"],
@@ -64,7 +218,7 @@ def _detect_category(file_path, file_extension):
 
     for category, keywords in categories.items():
         if any(keyword in file_path.lower() for keyword in keywords):
-            logger.info(f"Category detected from path: {category}")
+            logger.debug("Category detected from path: %s", category)
             return category
 
     extension_categories = {
@@ -79,38 +233,38 @@ def _detect_category(file_path, file_extension):
 
     for category, extensions in extension_categories.items():
         if file_extension.lower() in extensions:
-            logger.info(f"Category detected from file extension: {category}")
+            logger.debug("Category detected from file extension: %s", category)
             return category
 
-    logger.warning(f"No category matched for {file_path}. Categorized as 'other'")
+    logger.warning("No category matched for %s. Categorized as 'other'", file_path)
     return "other"
 
 def _load_exclusion_patterns(directory):
     """Load the .exclude_patterns file if it exists in the directory."""
     if directory is None:
         raise ValueError("Directory cannot be None. Please check your settings.")
-    logger.debug(f"Loading exclusion patterns from {directory}")
+    logger.debug("Loading exclusion patterns from %s", directory)
     exclude_file_path = os.path.join(directory, ".exclude_patterns")
     if os.path.exists(exclude_file_path):
         try:
             with open(exclude_file_path, "r") as f:
-                logger.info(f"Exclusion patterns loaded from {exclude_file_path}")
+                logger.info("Exclusion patterns loaded from %s", exclude_file_path)
                 return [re.compile(line.strip()) for line in f.readlines() if line.strip()]
         except Exception as e:
-            logger.error(f"Error loading exclusion patterns: {e}")
+            logger.error("Error loading exclusion patterns: %s", e)
     return []
 
 def _should_exclude(file_path, exclude_patterns):
     """Check if a file should be excluded based on the regex patterns."""
     for pattern in exclude_patterns:
         if pattern.search(file_path):
-            logger.info(f"File {file_path} excluded by pattern {pattern.pattern}")
+            logger.debug("File %s excluded by pattern %s", file_path, pattern.pattern)
             return True
     return False
     
-def _index_directory(directory, exclude_patterns, connection):
-    """Index the files in the given directory and its subdirectories."""
-    logger.debug(f"Indexing directory: {directory}")
+def _index_directory(directory, exclude_patterns, connection, stats):
+    """Index the files in the given directory and its subdirectories, counting outcomes in stats."""
+    logger.debug("Indexing directory: %s", directory)
     file_index = []
 
     for root, _, files in os.walk(directory):
@@ -119,9 +273,11 @@ def _index_directory(directory, exclude_patterns, connection):
                 continue  # Skip the .exclude_patterns file itself
 
             file_path = os.path.join(root, file_name)
+            stats['scanned'] += 1
 
             # Skip files that match the exclusion patterns
             if _should_exclude(file_path, exclude_patterns):
+                stats['excluded'] += 1
                 continue
 
             # Get file size and extension
@@ -129,29 +285,35 @@ def _index_directory(directory, exclude_patterns, connection):
             file_extension = os.path.splitext(file_name)[1]
 
             # Check if the file's MD5 hash already exists in the database
-            file_hash = _calculate_md5(file_path, connection)
+            file_hash, chunk_digests = _calculate_hashes(file_path, connection)
             if file_hash is None:
-                logger.error(f"Skipping {file_path} due to MD5 error")
+                logger.error("Skipping %s due to MD5 error", file_path)
+                stats['errors'] += 1
                 continue
+            if chunk_digests is not None:
+                stats['bytes_hashed'] += file_size
 
-            with connection.cursor() as cursor:
-                cursor.execute("SELECT * FROM files WHERE md5_hash = %s;", (file_hash,))
-                existing_file = cursor.fetchone()
+            cursor = connection.execute("SELECT * FROM files WHERE md5_hash = ?;", (file_hash,))
+            existing_file = cursor.fetchone()
 
             if existing_file:
-                logger.info(f"File already indexed: {file_name} (MD5: {file_hash})")
+                logger.debug("File already indexed: %s (MD5: %s)", file_name, file_hash)
+                stats['already_indexed'] += 1
                 continue  # Skip recalculation if the hash exists
 
             # Detect the file category
             file_category = _detect_category(file_path, file_extension)
 
             # Insert the new file entry into the database
-            with connection.cursor() as cursor:
-                cursor.execute("""
-                INSERT INTO files (file_name, path, md5_hash, file_size, category)
-                VALUES (%s, %s, %s, %s, %s);
-                """, (file_name, file_path, file_hash, file_size, file_category))
-                connection.commit()
+            connection.execute("""
+            INSERT INTO files (file_name, path, md5_hash, file_size, category)
+            VALUES (?, ?, ?, ?, ?);
+            """, (file_name, file_path, file_hash, file_size, file_category))
+            if chunk_digests is not None:
+                _store_chunk_hashes(file_hash, chunk_digests, connection)
+            if file_extension.lower() in ARCHIVE_EXTENSIONS:
+                _index_archive_members(file_path, file_hash, file_size, connection)
+            connection.commit()
 
             # Add to the index
             file_index.append({
@@ -161,7 +323,8 @@ def _index_directory(directory, exclude_patterns, connection):
                 "file_size": file_size,
                 "category": file_category,
             })
-            logger.info(f"Indexed {file_name} with category {file_category}")
+            logger.debug("Indexed %s with category %s", file_name, file_category)
+            stats['indexed'] += 1
 
     return file_index
 
@@ -173,7 +336,9 @@ def indexer(directory, connection):
     Args:
         directory (str): The directory to index.
     """
-    logger.debug(f"Starting indexing for directory {directory}")
+    # Paths are stored absolute and normalized, like the ones import_manifest() stores
+    directory = os.path.abspath(directory)
+    logger.debug("Starting indexing for directory %s", directory)
     
 
 
@@ -183,15 +348,182 @@ def indexer(directory, connection):
     # Load exclusion patterns from the parent directory
     exclude_patterns = _load_exclusion_patterns(directory)
 
-    # Index the directory
-    file_index = _index_directory(directory, exclude_patterns, connection)
+    # Index the directory, with one summary line per run instead of a line per file
+    stats = {'scanned': 0, 'indexed': 0, 'already_indexed': 0, 'excluded': 0, 'errors': 0, 'bytes_hashed': 0,
+             'chunks_backfilled': 0, 'archives_backfilled': 0}
+    started = time.monotonic()
+    file_index = _index_directory(directory, exclude_patterns, connection, stats)
+    backfill_chunk_hashes(connection, stats)
+    backfill_archive_members(connection, stats)
+    elapsed = time.monotonic() - started
 
-    logger.info(f"Indexing complete. {len(file_index)} files indexed.")
+    logger.info(
+        "Indexing complete in %.1fs: %d files scanned (%.1f files/s), %d indexed, %d already indexed, "
+        "%d excluded, %d errors, %d given chunk hashes, %d archives listed, %.1f MiB hashed (%.1f MiB/s)",
+        elapsed, stats['scanned'], stats['scanned'] / elapsed if elapsed else 0, stats['indexed'],
+        stats['already_indexed'], stats['excluded'], stats['errors'], stats['chunks_backfilled'],
+        stats['archives_backfilled'],
+        stats['bytes_hashed'] / 2 ** 20, stats['bytes_hashed'] / 2 ** 20 / elapsed if elapsed else 0
+    )
 
     # Close the database connection
     connection.close()
     logger.debug("Database connection closed.")
 
+# md5sum / .md5 lines ("<hash>  <path>", "<hash> *<path>"), BSD style ("MD5 (<path>) = <hash>") and SFV lines ("<path> <crc32>")
+MD5SUM_LINE = re.compile(r"^\\?([0-9a-fA-F]{32}) [ *](.+)$")
+BSD_MD5_LINE = re.compile(r"^\\?MD5 \((.+)\) = ([0-9a-fA-F]{32})$")
+SFV_LINE = re.compile(r"^(.+?)\s+([0-9a-fA-F]{8})$")
+
+def _unescape_manifest_path(line, path):
+    """Undo the escaping md5sum applies to file names with a backslash or newline (lines starting with a backslash)."""
+    if not line.startswith("\\"):
+        return path
+    return re.sub(r"\\(.)", lambda m: "\n" if m.group(1) == "n" else m.group(1), path)
+
+def _parse_manifest(manifest_path):
+    """
+    Read the entries of a checksum manifest.
+
+    SFV manifests only carry CRC32 checksums, so their files are listed with no
+    md5 and have to be hashed.
+
+    Yields:
+        tuple: (path as written in the manifest, lowercase md5 or None)
+    """
+    is_sfv = manifest_path.lower().endswith(".sfv")
+    with open(manifest_path, "r", encoding="utf-8", errors="surrogateescape") as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if not line.strip() or line.startswith((";", "#")):
+                continue
+            if is_sfv:
+                match = SFV_LINE.match(line)
+                if match:
+                    yield match.group(1), None
+                    continue
+            match = MD5SUM_LINE.match(line)
+            if match:
+                yield _unescape_manifest_path(line, match.group(2)), match.group(1).lower()
+                continue
+            match = BSD_MD5_LINE.match(line)
+            if match:
+                yield _unescape_manifest_path(line, match.group(1)), match.group(2).lower()
+                continue
+            logger.warning("Unrecognized line in %s: %s", manifest_path, line)
+
+def import_manifest(manifest_path, connection, root=None, verify_sample=0, batch_size=5000):
+    """
+    Add the files listed in a checksum manifest to the index without reading them.
+
+    md5sum, BSD and SFV manifests carry no file sizes, so the only check of a
+    listed file is that it exists; its size is taken from the file system.
+    Files modified after the manifest was written are hashed instead of
+    trusted, as are files of SFV manifests. With
+    verify_sample, that many random entries are hashed first and the whole
+    manifest is rejected on any mismatch. Rows are inserted in transactions of
+    batch_size. Files trusted from the manifest get their chunk hashes, and
+    archives their members, from the next indexer run.
+
+    Args:
+        manifest_path (str): The md5sum, .md5 or .sfv manifest.
+        connection (sqlite3.Connection): Connection to the local index.
+        root (str): Directory relative paths are resolved against, defaults to the manifest's directory.
+            Entries resolving outside of it are rejected.
+        verify_sample (int): Number of entries to hash before trusting the manifest.
+        batch_size (int): Rows per transaction.
+
+    Returns:
+        dict: Counts of 'listed', 'imported', 'hashed', 'already_indexed', 'excluded', 'missing' and
+        'rejected' (outside root) files, or None if the spot check failed.
+    """
+    started = time.monotonic()
+    init_db()
+    root = os.path.abspath(root or os.path.dirname(os.path.abspath(manifest_path)))
+    real_root = os.path.realpath(root)
+    manifest_mtime = os.path.getmtime(manifest_path)
+    exclude_patterns = _load_exclusion_patterns(root)
+    stats = {'listed': 0, 'imported': 0, 'hashed': 0, 'already_indexed': 0, 'excluded': 0, 'missing': 0, 'rejected': 0}
+
+    trusted, to_hash = [], []
+    for listed_path, md5 in _parse_manifest(manifest_path):
+        stats['listed'] += 1
+        file_path = os.path.normpath(os.path.join(root, listed_path))
+        # Absolute paths, ../ and symlinks must not publish files outside the shared root
+        if os.path.commonpath([real_root, os.path.realpath(file_path)]) != real_root:
+            logger.warning("Listed file %s is outside %s, skipping it", listed_path, root)
+            stats['rejected'] += 1
+            continue
+        if _should_exclude(file_path, exclude_patterns):
+            stats['excluded'] += 1
+            continue
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            logger.debug("Listed file %s does not exist", file_path)
+            stats['missing'] += 1
+            continue
+        # A file changed since the manifest was written may no longer match its hash
+        if md5 is None or stat.st_mtime > manifest_mtime:
+            to_hash.append((file_path, stat.st_size))
+        else:
+            trusted.append((file_path, stat.st_size, md5))
+
+    if verify_sample and trusted:
+        for file_path, _, md5 in random.sample(trusted, min(verify_sample, len(trusted))):
+            actual = hashlib.md5()
+            with open(file_path, "rb") as f:
+                for block in iter(lambda: f.read(READ_SIZE), b""):
+                    actual.update(block)
+            actual = actual.hexdigest()
+            if actual != md5:
+                logger.error("Spot check failed for %s: manifest says %s, file hashes to %s, not importing %s",
+                             file_path, md5, actual, manifest_path)
+                return None
+        logger.info("Spot check of %d files from %s passed", min(verify_sample, len(trusted)), manifest_path)
+
+    def rows():
+        for file_path, file_size, md5 in trusted:
+            yield file_path, file_size, md5, None
+        for file_path, file_size in to_hash:
+            md5, chunk_digests = _calculate_hashes(file_path, connection)
+            if md5 is not None:
+                # An md5 already indexed for the path is reused without reading the file
+                if chunk_digests is not None:
+                    stats['hashed'] += 1
+                yield file_path, file_size, md5, chunk_digests
+
+    # Same rule as the indexer: a path or content already in the index is skipped
+    insert = """
+        INSERT INTO files (file_name, path, md5_hash, file_size, category)
+        SELECT ?, ?, ?, ?, ?
+        WHERE NOT EXISTS (SELECT 1 FROM files WHERE md5_hash = ? OR path = ?);
+    """
+    batch = iter(rows())
+    while True:
+        chunk = list(itertools.islice(batch, batch_size))
+        if not chunk:
+            break
+        with connection:
+            for file_path, file_size, md5, chunk_digests in chunk:
+                file_name = os.path.basename(file_path)
+                category = _detect_category(file_path, os.path.splitext(file_name)[1])
+                cursor = connection.execute(insert, (file_name, file_path, md5, file_size, category, md5, file_path))
+                if cursor.rowcount:
+                    stats['imported'] += 1
+                    if chunk_digests is not None:
+                        _store_chunk_hashes(md5, chunk_digests, connection)
+                else:
+                    stats['already_indexed'] += 1
+
+    logger.info(
+        "Imported %s in %.1fs: %d listed, %d imported, %d hashed, %d already indexed, %d excluded, %d missing, "
+        "%d outside the root",
+        manifest_path, time.monotonic() - started, stats['listed'], stats['imported'], stats['hashed'],
+        stats['already_indexed'], stats['excluded'], stats['missing'], stats['rejected']
+    )
+    return stats
+
 # Example usage
 # indexer("/path/to/directory")
 
@@ -0,0 +1,82 @@
+import os
+import time
+import threading
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+LOCK_FILE = os.getenv("SCHEDULER_LOCK_FILE", "scheduler.lock")
+# Seconds between attempts of a follower to take over
+RETRY_INTERVAL = 5
+
+# Open lock file of this process while it is the leader
+_lock_file = None
+_election_thread = None
+
+def try_acquire(path=LOCK_FILE):
+    """
+    Try to become the leader by taking an exclusive lock on the lock file.
+
+    The lock belongs to the open file, so the kernel releases it as soon as
+    the leader process exits or is killed, and a follower can take over.
+    Without fcntl (e.g. on Windows) every process is its own leader.
+
+    Returns:
+        bool: True if this process is the leader.
+    """
+    global _lock_file
+    if _lock_file is not None:
+        return True
+    if fcntl is None:
+        logger.warning("fcntl is not available, running background jobs in this process")
+        _lock_file = True
+        return True
+
+    lock_file = open(path, "a+")
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+
+    # Record who holds the lock, for whoever is debugging a stuck node
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(f"{os.getpid()}\n")
+    lock_file.flush()
+    _lock_file = lock_file
+    return True
+
+def is_leader():
+    """Return True if this process runs the background jobs."""
+    return _lock_file is not None
+
+def _elect(on_elected, retry_interval):
+    """Wait until this process becomes the leader, then run on_elected."""
+    while not try_acquire():
+        time.sleep(retry_interval)
+    logger.info("Process %s is the leader, starting background jobs", os.getpid())
+    on_elected()
+
+def start_election(on_elected, retry_interval=RETRY_INTERVAL):
+    """
+    Run on_elected once this process becomes the leader.
+
+    Only one process holding the lock file runs background jobs; the others
+    keep serving requests and retry every retry_interval seconds, so one of
+    them takes over if the leader dies.
+
+    Args:
+        on_elected (callable): Called once, in a background thread, when elected.
+        retry_interval (float): Seconds between attempts to take the lock.
+    """
+    global _election_thread
+    if _election_thread is not None:
+        return
+    _election_thread = threading.Thread(target=_elect, args=(on_elected, retry_interval), name="leader-election", daemon=True)
+    _election_thread.start()
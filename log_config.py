@@ -0,0 +1,99 @@
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from colorlog import ColoredFormatter
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(log_color)s%(levelname)s%(reset)s - %(message)s"
+LOG_COLORS = {
+    'DEBUG': 'cyan',
+    'INFO': 'green',
+    'WARNING': 'yellow',
+    'ERROR': 'red',
+    'CRITICAL': 'bold_red',
+}
+# Messages logged from one template at most RATE_LIMIT_BURST times per RATE_LIMIT_INTERVAL seconds
+RATE_LIMIT_INTERVAL = 1.0
+RATE_LIMIT_BURST = 20
+
+_listener = None
+_setup_lock = threading.Lock()
+
+def rate_limit_filter(interval=RATE_LIMIT_INTERVAL, burst=RATE_LIMIT_BURST):
+    """
+    Build a logging filter that drops repeats of the same message template.
+
+    Records are grouped by logger and unformatted message, so every per-file
+    message of a loop shares one budget whatever its arguments. The first
+    record let through after some were dropped reports how many.
+
+    Args:
+        interval (float): Length of a window in seconds.
+        burst (int): Records of one template let through per window.
+
+    Returns:
+        callable: The filter, to pass to addFilter().
+    """
+    windows = {}
+    lock = threading.Lock()
+
+    def filter_record(record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with lock:
+            started, count, dropped = windows.get(key, (now, 0, 0))
+            if now - started >= interval:
+                started, count = now, 0
+            if count >= burst:
+                windows[key] = (started, count, dropped + 1)
+                return False
+            windows[key] = (started, count + 1, 0)
+
+        if dropped and isinstance(record.args, tuple):
+            # A message logged without arguments isn't %-formatted, so a literal % must be escaped first
+            msg = record.msg if record.args else str(record.msg).replace('%', '%%')
+            record.msg = f"{msg} (%d similar messages suppressed)"
+            record.args = record.args + (dropped,)
+        return True
+
+    return filter_record
+
+def setup_logging(level=None):
+    """
+    Configure the single logging pipeline of the process.
+
+    Every module logs through logging.getLogger(__name__) to the root logger,
+    whose only handler puts records on a queue; a listener thread adds the
+    colored prefix and writes them, so a slow terminal or log collector never
+    blocks a request or the indexer. The message itself is still %-formatted
+    by the QueueHandler on the logging thread, but only for records that
+    pass the level check and the rate limit. Calling it again does nothing.
+
+    Args:
+        level (str): Log level, defaults to the LOG_LEVEL environment variable or INFO.
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(ColoredFormatter(LOG_FORMAT, datefmt="%Y-%m-%d %H:%M:%S", log_colors=LOG_COLORS))
+
+        log_queue = queue.SimpleQueue()
+        queue_handler = QueueHandler(log_queue)
+        queue_handler.addFilter(rate_limit_filter())
+
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+        root.setLevel(level or os.getenv("LOG_LEVEL", "INFO").upper())
+
+        _listener = QueueListener(log_queue, console_handler, respect_handler_level=True)
+        _listener.start()
+        # Flush what is still queued when the process exits
+        atexit.register(_listener.stop)
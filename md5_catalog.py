@@ -0,0 +1,326 @@
+import os
+import json
+import mmap
+import time
+import heapq
+import struct
+import tempfile
+import logging
+import threading
+from array import array
+
+logger = logging.getLogger(__name__)
+
+# A compact md5 -> file table kept in one file that every worker maps into memory.
+#
+# Layout, little endian:
+#   header: magic, entry count, highest files.seq included, length of the metadata
+#   metadata: JSON with the category names and per-category file counts
+#   digests: count * 16 bytes, sorted, for binary search
+#   sizes: count * uint64
+#   categories: count * uint8, index into the category names
+#   path offsets: (count + 1) * uint64, entry i's path is blob[offsets[i]:offsets[i + 1]]
+#   path blob: UTF-8 paths, back to back
+#
+# That is about 33 bytes per file plus its path, instead of a few hundred for a
+# dict entry, and the pages are shared by every process mapping the file.
+
+CATALOG_FILE = os.getenv("MEMORY_CATALOG_FILE", "md5_catalog.bin")
+MAGIC = b"0dinmd5\x01"
+_HEADER = struct.Struct("<8sQQQ")
+# Seconds between checks for a newer catalog file
+RELOAD_CHECK_INTERVAL = 1.0
+
+_lock = threading.Lock()
+# Held while building or refreshing, the indexer and the refresh job may both write the catalog
+_write_lock = threading.Lock()
+# (file identity, mmap, section offsets) of the catalog currently mapped by this process
+_mapped = None
+_checked_at = 0.0
+
+def _sections(count, meta_len):
+    """Return the offsets of every section of a catalog file."""
+    digests = _HEADER.size + meta_len
+    sizes = digests + 16 * count
+    categories = sizes + 8 * count
+    offsets = categories + count
+    blob = offsets + 8 * (count + 1)
+    return {'digests': digests, 'sizes': sizes, 'categories': categories, 'offsets': offsets, 'blob': blob}
+
+def _write(entries, max_seq, path):
+    """
+    Write sorted (digest, path, category, size) entries to a new catalog file.
+
+    The file is written next to the old one and swapped in with os.replace(), so
+    readers see either the old or the new catalog, never a partial one.
+    """
+    digests = bytearray()
+    sizes = array('Q')
+    category_ids = bytearray()
+    offsets = array('Q', [0])
+    blob = bytearray()
+    names, counts = [], []
+    name_ids = {}
+
+    for digest, file_path, category, size in entries:
+        category = category or 'other'
+        category_id = name_ids.get(category)
+        if category_id is None and len(names) >= 255 and category != 'other':
+            # One byte per entry, so at most 256 categories; the rest count as 'other'
+            category = 'other'
+            category_id = name_ids.get(category)
+        if category_id is None:
+            category_id = name_ids[category] = len(names)
+            names.append(category)
+            counts.append(0)
+        counts[category_id] += 1
+        digests += digest
+        sizes.append(size or 0)
+        category_ids.append(category_id)
+        blob += file_path.encode('utf-8', 'surrogateescape')
+        offsets.append(len(blob))
+
+    if sizes.itemsize != 8 or offsets.itemsize != 8:
+        raise RuntimeError("array('Q') is not 64 bits on this platform")
+    if array('Q', [1]).tobytes()[0] != 1:
+        sizes.byteswap()
+        offsets.byteswap()
+
+    meta = json.dumps({'categories': names, 'counts': counts}).encode('utf-8')
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, len(sizes), max_seq, len(meta)))
+            f.write(meta)
+            f.write(digests)
+            f.write(sizes.tobytes())
+            f.write(category_ids)
+            f.write(offsets.tobytes())
+            f.write(blob)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return len(sizes)
+
+def _rows_to_entries(rows):
+    """Turn (md5_hash, path, category, file_size) rows sorted by md5 into entries, one per md5."""
+    previous = None
+    for md5_hash, file_path, category, size in rows:
+        try:
+            digest = bytes.fromhex(md5_hash)
+        except (TypeError, ValueError):
+            continue
+        if len(digest) != 16 or digest == previous:
+            continue
+        previous = digest
+        yield digest, file_path, category, size
+
+def _iter_entries(mapped):
+    """Yield every entry of a mapped catalog as (digest, path, category, size)."""
+    _, mm, layout = mapped
+    names = layout['categories_names']
+    for i in range(layout['count']):
+        yield _entry(mm, layout, i, names)
+
+def _entry(mm, layout, i, names):
+    digest = mm[layout['digests'] + 16 * i:layout['digests'] + 16 * (i + 1)]
+    size, = struct.unpack_from('<Q', mm, layout['sizes'] + 8 * i)
+    start, end = struct.unpack_from('<QQ', mm, layout['offsets'] + 8 * i)
+    file_path = mm[layout['blob'] + start:layout['blob'] + end].decode('utf-8', 'surrogateescape')
+    return digest, file_path, names[mm[layout['categories'] + i]], size
+
+def build(conn, path=None):
+    """
+    Build the catalog from scratch out of the files table.
+
+    Returns:
+        int: Number of entries written.
+    """
+    with _write_lock:
+        return _build(conn, path or CATALOG_FILE)
+
+def _build(conn, path):
+    """build() without the lock. Caller must hold _write_lock."""
+    max_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM files;").fetchone()[0]
+    rows = conn.execute("SELECT md5_hash, path, category, file_size FROM files ORDER BY md5_hash, id;")
+    count = _write(_rows_to_entries(rows), max_seq, path)
+    logger.info("Built in-memory catalog with %d files", count)
+    return count
+
+def refresh(conn, path=None):
+    """
+    Bring the catalog up to date with the files table.
+
+    Only rows whose sequence number is above the one the catalog was built at are
+    read from SQLite and merged into the existing entries; rows the catalog
+    already holds as is, like download count updates, only move its sequence
+    number forward without rewriting the file. If the merged catalog
+    doesn't have one entry per distinct md5, files were deleted and it is rebuilt
+    from scratch.
+
+    Returns:
+        int: Number of entries in the catalog.
+    """
+    with _write_lock:
+        return _refresh(conn, path or CATALOG_FILE)
+
+def _refresh(conn, path):
+    """refresh() without the lock. Caller must hold _write_lock."""
+    mapped = _current(path, force=True)
+    if mapped is None:
+        return _build(conn, path)
+
+    layout = mapped[2]
+    changes = list(_rows_to_entries(conn.execute(
+        "SELECT md5_hash, path, category, file_size FROM files WHERE seq > ? ORDER BY md5_hash, id;",
+        (layout['max_seq'],)
+    )))
+    max_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM files;").fetchone()[0]
+    expected = conn.execute("SELECT COUNT(DISTINCT md5_hash) FROM files;").fetchone()[0]
+
+    # Most changes are download counts, which the catalog doesn't store: drop rows it already has as is
+    replaced = 0
+    fresh = []
+    for digest, file_path, category, size in changes:
+        index = _find(mapped, digest)
+        if index is not None:
+            if _entry(mapped[1], layout, index, layout['categories_names'])[1:] == (file_path, category or 'other', size or 0):
+                continue
+            replaced += 1
+        fresh.append((digest, file_path, category, size))
+    changes = fresh
+
+    count = layout['count'] - replaced + len(changes)
+    if count != expected:
+        logger.info("In-memory catalog has %d files but the index %d, rebuilding it", count, expected)
+        return _build(conn, path)
+    if not changes:
+        if max_seq != layout['max_seq']:
+            _set_max_seq(path, layout, max_seq)
+        return count
+
+    changed = {entry[0] for entry in changes}
+    kept = (entry for entry in _iter_entries(mapped) if entry[0] not in changed)
+    count = _write(heapq.merge(kept, changes, key=lambda entry: entry[0]), max_seq, path)
+    logger.info("Merged %d changes into the in-memory catalog, now %d files", len(changes), count)
+    return count
+
+def _set_max_seq(path, layout, max_seq):
+    """
+    Move the sequence number of an up to date catalog forward in place.
+
+    Only the header changes, so unchanged rows aren't read again on the next
+    refresh and the file isn't rewritten. Caller must hold _write_lock.
+    """
+    with open(path, 'r+b') as f:
+        # max_seq follows the magic and the entry count
+        f.seek(struct.calcsize('<8sQ'))
+        f.write(struct.pack('<Q', max_seq))
+    layout['max_seq'] = max_seq
+
+def _load(path):
+    """Map a catalog file and read its layout, or return None if there is none."""
+    try:
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size < _HEADER.size:
+                return None
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError:
+        return None
+
+    magic, count, max_seq, meta_len = _HEADER.unpack_from(mm)
+    if magic != MAGIC:
+        logger.warning("%s is not an in-memory catalog file", path)
+        return None
+    meta = json.loads(mm[_HEADER.size:_HEADER.size + meta_len])
+    layout = _sections(count, meta_len)
+    layout.update(count=count, max_seq=max_seq, categories_names=meta['categories'], counts=meta['counts'])
+    return (stat.st_ino, stat.st_mtime_ns), mm, layout
+
+def _current(path=None, force=False):
+    """
+    Return the mapped catalog, remapping it when the file was replaced.
+
+    The file is checked at most once per RELOAD_CHECK_INTERVAL. An old mapping is
+    never closed explicitly: a thread may still be reading it, and it goes away
+    with its last reference.
+    """
+    global _mapped, _checked_at
+    path = path or CATALOG_FILE
+    now = time.monotonic()
+    with _lock:
+        if not force and _mapped is not None and now - _checked_at < RELOAD_CHECK_INTERVAL:
+            return _mapped
+        _checked_at = now
+        try:
+            stat = os.stat(path)
+            identity = (stat.st_ino, stat.st_mtime_ns)
+        except OSError:
+            _mapped = None
+            return None
+        if _mapped is None or _mapped[0] != identity:
+            _mapped = _load(path)
+        return _mapped
+
+def _find(mapped, digest):
+    """Binary search a digest, returning its index or None."""
+    _, mm, layout = mapped
+    base = layout['digests']
+    lo, hi = 0, layout['count']
+    while lo < hi:
+        mid = (lo + hi) // 2
+        value = mm[base + 16 * mid:base + 16 * mid + 16]
+        if value < digest:
+            lo = mid + 1
+        elif value > digest:
+            hi = mid
+        else:
+            return mid
+    return None
+
+def lookup(md5_hash):
+    """
+    Resolve an md5 hash to the file hosting it.
+
+    Returns:
+        dict: 'path', 'category' and 'file_size', or None if the hash isn't in the
+        catalog or there is no catalog.
+    """
+    mapped = _current()
+    if mapped is None:
+        return None
+    try:
+        digest = bytes.fromhex(md5_hash)
+    except ValueError:
+        return None
+    index = _find(mapped, digest)
+    if index is None:
+        return None
+    _, file_path, category, size = _entry(mapped[1], mapped[2], index, mapped[2]['categories_names'])
+    return {'path': file_path, 'category': category, 'file_size': size}
+
+def contains(md5_hash):
+    """
+    Check whether an md5 hash is in the catalog.
+
+    Returns:
+        bool: True or False, or None when there is no catalog to answer from.
+    """
+    mapped = _current()
+    if mapped is None:
+        return None
+    try:
+        return _find(mapped, bytes.fromhex(md5_hash)) is not None
+    except ValueError:
+        return False
+
+def category_counts():
+    """Return the number of files per category, or None when there is no catalog."""
+    mapped = _current()
+    if mapped is None:
+        return None
+    layout = mapped[2]
+    return dict(zip(layout['categories_names'], layout['counts']))
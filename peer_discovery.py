@@ -1,24 +1,11 @@
 import requests
 import time
+import random
+import hashlib
 import logging
-import colorlog
-
-# Configure logging
-handler = colorlog.StreamHandler()
-handler.setFormatter(colorlog.ColoredFormatter(
-    '%(log_color)s%(asctime)s - %(levelname)s - %(message)s',
-    log_colors={
-        'DEBUG': 'cyan',
-        'INFO': 'green',
-        'WARNING': 'yellow',
-        'ERROR': 'red',
-        'CRITICAL': 'bold_red',
-    }
-))
+from concurrent.futures import ThreadPoolExecutor
 
-logger = colorlog.getLogger(__name__)
-logger.addHandler(handler)
-logger.setLevel(logging.DEBUG)
+logger = logging.getLogger(__name__)
 
 
 def _check_internet_connection(test_url="http://www.google.com", timeout=5):
@@ -34,10 +21,10 @@ def _check_internet_connection(test_url="http://www.google.com", timeout=5):
     """
     try:
         response = requests.get(test_url, timeout=timeout)
-        logger.info(f"Internet connection check: {response.status_code == 200}")
+        logger.debug("Internet connection check: %s", response.status_code == 200)
         return response.status_code == 200
     except requests.RequestException as e:
-        logger.error(f"Internet connection check failed: {e}")
+        logger.error("Internet connection check failed: %s", e)
         return False
 
 
@@ -58,19 +45,19 @@ def announce(announce_url, node_id, known_nodes, max_retries=3, timeout=5):
     payload = {"node_id": node_id}
     for attempt in range(max_retries):
         try:
-            logger.debug(f"Announcing to {announce_url}, attempt {attempt + 1}")
+            logger.debug("Announcing to %s, attempt %s", announce_url, attempt + 1)
             response = requests.post(announce_url, json=payload, timeout=timeout)
             response.raise_for_status()
             response_data = response.json()
             received_nodes = response_data.get("known_nodes", [])
             known_nodes.update(received_nodes)
-            logger.info(f"Announcement successful, known nodes received: {received_nodes}")
+            logger.info("Announcement successful, known nodes received: %s", received_nodes)
             return set(received_nodes)
         except requests.RequestException as e:
-            logger.warning(f"Attempt {attempt + 1} failed: {e}")
+            logger.warning("Attempt %s failed: %s", attempt + 1, e)
             time.sleep(2 ** attempt)
     
-    logger.error(f"Failed to announce to {announce_url} after {max_retries} attempts")
+    logger.error("Failed to announce to %s after %s attempts", announce_url, max_retries)
     return set()
 
 def heartbeat_ping(node_url, timeout=5):
@@ -78,26 +65,294 @@ def heartbeat_ping(node_url, timeout=5):
     Send a heartbeat ping to a node to check if it is still alive.
     
     Args:
-        node_url (str): URL of the node to ping.
+        node_url (str): Base URL of the node to ping (e.g., 'http://ip:port').
         timeout (int): Timeout for the request in seconds.
     
     Returns:
-        int: 0 if the heartbeat page is valid, 1 if it is invalid, 2 if there is no internet connection.
+        int: 0 if the heartbeat page is valid, 1 if it is invalid or unreachable.
     """
-    if not _check_internet_connection():
-        logger.warning("No internet connection available.")
-        return 2
-
     try:
-        logger.debug(f"Pinging node at {node_url}")
+        logger.debug("Pinging node at %s", node_url)
         response = requests.get(f"{node_url}/heartbeat", timeout=timeout)
         if response.status_code == 200 and 'heartbeat' in response.text:
-            logger.info(f"Heartbeat valid from {node_url}")
+            logger.debug("Heartbeat valid from %s", node_url)
             return 0
         else:
-            logger.warning(f"Invalid or unreachable node at {node_url}")
+            logger.warning("Invalid or unreachable node at %s", node_url)
             return 1
     except requests.RequestException as e:
-        logger.error(f"Node {node_url} unreachable: {e}")
+        logger.error("Node %s unreachable: %s", node_url, e)
         return 1
 
+def heartbeat_round(nodes, max_workers=32, timeout=5):
+    """
+    Ping a set of nodes concurrently, after a single internet connection check for the whole round.
+
+    Args:
+        nodes (iterable): Node IDs to ping.
+        max_workers (int): Maximum number of pings in flight.
+        timeout (int): Timeout for each ping in seconds.
+
+    Returns:
+        dict: Result of heartbeat_ping for each node, or None if there is no internet connection.
+    """
+    if not _check_internet_connection():
+        logger.warning("No internet connection available.")
+        return None
+
+    nodes = list(nodes)
+    if not nodes:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(nodes))) as executor:
+        results = executor.map(lambda node: heartbeat_ping(f"http://{node}", timeout), nodes)
+        return dict(zip(nodes, results))
+
+def update_liveness(results, conn, failure_threshold=3):
+    """
+    Persist the outcome of a heartbeat round and decide which nodes to evict.
+
+    A reachable node gets its last_seen timestamp refreshed and its failure count
+    reset; an unreachable one has its failure count increased, and is only evicted
+    once it reaches failure_threshold consecutive misses.
+
+    Args:
+        results (dict): Result of heartbeat_ping for each node.
+        conn (sqlite3.Connection): Connection to the local index.
+        failure_threshold (int): Consecutive missed heartbeats before eviction.
+
+    Returns:
+        set: Nodes to remove from known_nodes.
+    """
+    now = time.time()
+    with conn:
+        for node, result in results.items():
+            if result == 0:
+                conn.execute("""
+                    INSERT INTO node_liveness (node_id, last_seen, last_checked, failures) VALUES (?, ?, ?, 0)
+                    ON CONFLICT (node_id) DO UPDATE SET last_seen = excluded.last_seen,
+                        last_checked = excluded.last_checked, failures = 0;
+                """, (node, now, now))
+            else:
+                conn.execute("""
+                    INSERT INTO node_liveness (node_id, last_seen, last_checked, failures) VALUES (?, NULL, ?, 1)
+                    ON CONFLICT (node_id) DO UPDATE SET last_checked = excluded.last_checked, failures = failures + 1;
+                """, (node, now))
+
+        evicted = {
+            node for (node,) in conn.execute(
+                "SELECT node_id FROM node_liveness WHERE failures >= ?;", (failure_threshold,)
+            ) if node in results
+        }
+        # Evicted nodes start over if they are ever rediscovered
+        conn.executemany("DELETE FROM node_liveness WHERE node_id = ?;", ((node,) for node in evicted))
+    return evicted
+
+def get_liveness(conn):
+    """
+    Return the persisted liveness of every node.
+
+    Returns:
+        dict: {'last_seen', 'last_checked', 'failures'} for each node, keyed by node_id.
+    """
+    return {
+        node: {'last_seen': last_seen, 'last_checked': last_checked, 'failures': failures}
+        for node, last_seen, last_checked, failures in conn.execute(
+            "SELECT node_id, last_seen, last_checked, failures FROM node_liveness;"
+        )
+    }
+
+def _member_row(conn, node):
+    return conn.execute("SELECT incarnation, status FROM members WHERE node_id = ?;", (node,)).fetchone()
+
+def _merge_member(conn, node_id, node, incarnation, status):
+    """
+    Apply one membership entry, keeping whichever version is newer.
+
+    A higher incarnation wins; at equal incarnations 'dead' beats 'alive'. An entry
+    claiming this node is dead is refuted by moving to a higher incarnation.
+
+    Returns:
+        bool: True if the local membership changed.
+    """
+    row = _member_row(conn, node)
+    if node == node_id:
+        if row is not None and (incarnation < row[0] or (incarnation == row[0] and status == 'alive')):
+            return False
+        conn.execute(
+            "INSERT OR REPLACE INTO members (node_id, incarnation, status, updated_at) VALUES (?, ?, 'alive', ?);",
+            (node, incarnation + 1, time.time())
+        )
+        logger.info("Refuted membership entry %s/%s about this node", incarnation, status)
+        return True
+
+    if row is not None and (incarnation < row[0] or (incarnation == row[0] and (status == row[1] or status == 'alive'))):
+        return False
+    conn.execute(
+        "INSERT OR REPLACE INTO members (node_id, incarnation, status, updated_at) VALUES (?, ?, ?, ?);",
+        (node, incarnation, status, time.time())
+    )
+    return True
+
+def merge_members(entries, conn, node_id):
+    """
+    Merge membership entries received from a peer.
+
+    Args:
+        entries (list): [node_id, incarnation, status] entries.
+        conn (sqlite3.Connection): Connection to the local index.
+        node_id (str): The ID of the current node.
+
+    Returns:
+        int: Number of entries that changed the local membership.
+    """
+    changed = 0
+    with conn:
+        for node, incarnation, status in entries:
+            if node and status in ('alive', 'dead'):
+                changed += _merge_member(conn, node_id, node, int(incarnation), status)
+    return changed
+
+def ensure_self(conn, node_id):
+    """Add this node to the membership, with the current time as its first incarnation."""
+    with conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO members (node_id, incarnation, status, updated_at) VALUES (?, ?, 'alive', ?);",
+            (node_id, int(time.time()), time.time())
+        )
+
+def add_seed_nodes(nodes, conn):
+    """Add nodes learned outside of gossip (node list, announcements) at the lowest incarnation."""
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO members (node_id, incarnation, status, updated_at) VALUES (?, 0, 'alive', ?);",
+            ((node, time.time()) for node in nodes if node)
+        )
+
+def mark_dead(nodes, conn):
+    """Declare nodes dead at their current incarnation, so the eviction is gossiped to other nodes."""
+    with conn:
+        conn.executemany(
+            "UPDATE members SET status = 'dead', updated_at = ? WHERE node_id = ? AND status = 'alive';",
+            ((time.time(), node) for node in nodes)
+        )
+
+def alive_members(conn, node_id):
+    """Return every member believed alive, except the current node."""
+    return {
+        node for (node,) in conn.execute("SELECT node_id FROM members WHERE status = 'alive' AND node_id != ?;", (node_id,))
+    }
+
+def member_changes(conn, since):
+    """
+    Return the membership entries changed after a local sequence number.
+
+    Returns:
+        tuple: ([node_id, incarnation, status] entries, highest local sequence number).
+    """
+    entries = [
+        list(row) for row in conn.execute(
+            "SELECT node_id, incarnation, status FROM members WHERE seq > ? ORDER BY seq;", (since,)
+        )
+    ]
+    last_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM members;").fetchone()[0]
+    return entries, last_seq
+
+def membership_digest(conn):
+    """Return a hash of the whole membership, equal on two nodes exactly when they agree."""
+    digest = hashlib.sha1()
+    for node, incarnation, status in conn.execute("SELECT node_id, incarnation, status FROM members ORDER BY node_id;"):
+        digest.update(f"{node}\t{incarnation}\t{status}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+def _peer_watermarks(conn, node):
+    row = conn.execute("SELECT received_seq, sent_seq, mismatches FROM gossip_peers WHERE node_id = ?;", (node,)).fetchone()
+    return row if row else (0, 0, 0)
+
+def _set_peer_watermarks(conn, node, received_seq, sent_seq, mismatches=0):
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO gossip_peers (node_id, received_seq, sent_seq, mismatches) VALUES (?, ?, ?, ?);",
+            (node, received_seq, sent_seq, mismatches)
+        )
+
+def handle_gossip(data, conn, node_id):
+    """
+    Answer a gossip exchange from a peer.
+
+    The peer sends the membership changes it has not yet sent us and the last
+    of our sequence numbers it has; we merge its changes and answer with ours
+    since that point, plus a digest of the merged membership.
+
+    Args:
+        data (dict): The request body, with 'node_id', 'updates', 'seq' and 'since'.
+        conn (sqlite3.Connection): Connection to the local index.
+        node_id (str): The ID of the current node.
+
+    Returns:
+        dict: The response body, with 'updates', 'seq' and 'digest'.
+    """
+    peer = data['node_id']
+    ensure_self(conn, node_id)
+    merge_members(data.get('updates', []), conn, node_id)
+    add_seed_nodes([peer], conn)
+
+    updates, last_seq = member_changes(conn, int(data.get('since', 0)))
+    known_seq, _, mismatches = _peer_watermarks(conn, peer)
+    _set_peer_watermarks(conn, peer, max(known_seq, int(data.get('seq', 0))), last_seq, mismatches)
+    return {'node_id': node_id, 'updates': updates, 'seq': last_seq, 'digest': membership_digest(conn)}
+
+def gossip_with(node, conn, node_id, timeout=5, mismatch_threshold=3):
+    """
+    Exchange membership changes with one peer.
+
+    Only entries changed since the previous exchange travel in each direction.
+    Digests often differ for a moment while suspicions and refutations spread,
+    so only after mismatch_threshold exchanges in a row end with different
+    digests is a change assumed missed: both watermarks are reset and the next
+    exchange with this peer is a full one.
+
+    Returns:
+        bool: True if the peer answered.
+    """
+    received_seq, sent_seq, mismatches = _peer_watermarks(conn, node)
+    updates, last_seq = member_changes(conn, sent_seq)
+    payload = {'node_id': node_id, 'updates': updates, 'seq': last_seq, 'since': received_seq}
+
+    response = requests.post(f"http://{node}/gossip", json=payload, timeout=timeout)
+    if response.status_code == 404:
+        # Node without gossip support, fall back to a full announcement
+        received_nodes = announce(f"http://{node}/announce", node_id, set(), max_retries=1, timeout=timeout)
+        add_seed_nodes(received_nodes, conn)
+        return bool(received_nodes)
+    response.raise_for_status()
+    answer = response.json()
+
+    changed = merge_members(answer.get('updates', []), conn, node_id)
+    if answer.get('digest') == membership_digest(conn):
+        _set_peer_watermarks(conn, node, int(answer.get('seq', 0)), last_seq)
+    elif mismatches + 1 < mismatch_threshold:
+        _set_peer_watermarks(conn, node, int(answer.get('seq', 0)), last_seq, mismatches + 1)
+    else:
+        logger.info("Membership of %s differed after %s exchanges in a row, next exchange will be a full one", node, mismatches + 1)
+        _set_peer_watermarks(conn, node, 0, 0)
+    logger.debug("Gossiped with %s: sent %s, received %s, %s changes", node, len(updates), len(answer.get('updates', [])), changed)
+    return True
+
+def gossip_round(conn, node_id, fanout=3, timeout=5, mismatch_threshold=3):
+    """
+    Gossip with a bounded random sample of live members.
+
+    Each node contacts at most `fanout` peers per round whatever the size of the
+    network, and changes spread to every node in O(log N) rounds.
+
+    Returns:
+        set: Members believed alive after the round, except the current node.
+    """
+    ensure_self(conn, node_id)
+    peers = list(alive_members(conn, node_id))
+    for node in random.sample(peers, min(fanout, len(peers))):
+        try:
+            gossip_with(node, conn, node_id, timeout, mismatch_threshold)
+        except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+            logger.warning("Gossip with %s failed: %s", node, e)
+    return alive_members(conn, node_id)
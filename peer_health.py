@@ -0,0 +1,216 @@
+import time
+import threading
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Weight of the newest sample in the moving averages
+EWMA_ALPHA = 0.2
+# Number of recent latencies kept per node for percentiles
+LATENCY_WINDOW = 50
+
+_lock = threading.Lock()
+_health = {}
+
+def _entry(node_id):
+    """Return the health entry of a node, creating it if needed. Caller must hold _lock."""
+    entry = _health.get(node_id)
+    if entry is None:
+        entry = {
+            'latency_ewma': None,
+            'latencies': deque(maxlen=LATENCY_WINDOW),
+            'error_rate': 0.0,
+            'yield_ewma': 0.0,
+            'requests': 0,
+            'errors': 0,
+            'consecutive_failures': 0,
+            'state': 'closed',
+            'opened_at': None,
+        }
+        _health[node_id] = entry
+    return entry
+
+def _ewma(previous, sample):
+    return sample if previous is None else EWMA_ALPHA * sample + (1 - EWMA_ALPHA) * previous
+
+def record_success(node_id, latency, result_count):
+    """
+    Record a successful request to a node and close its circuit.
+
+    Args:
+        node_id (str): The node that answered.
+        latency (float): Request duration in seconds.
+        result_count (int): Number of results returned.
+    """
+    with _lock:
+        entry = _entry(node_id)
+        entry['requests'] += 1
+        entry['latencies'].append(latency)
+        entry['latency_ewma'] = _ewma(entry['latency_ewma'], latency)
+        entry['error_rate'] = _ewma(entry['error_rate'], 0.0)
+        entry['yield_ewma'] = _ewma(entry['yield_ewma'], result_count)
+        entry['consecutive_failures'] = 0
+        if entry['state'] != 'closed':
+            logger.info("Circuit for %s closed", node_id)
+        entry['state'] = 'closed'
+        entry['opened_at'] = None
+
+def record_failure(node_id, failure_threshold=3):
+    """
+    Record a failed request to a node, opening its circuit after too many consecutive failures.
+
+    Args:
+        node_id (str): The node that failed.
+        failure_threshold (int): Consecutive failures that open the circuit.
+    """
+    with _lock:
+        entry = _entry(node_id)
+        entry['requests'] += 1
+        entry['errors'] += 1
+        entry['error_rate'] = _ewma(entry['error_rate'], 1.0)
+        entry['consecutive_failures'] += 1
+        # A failed probe while half-open reopens the circuit immediately
+        if entry['state'] == 'half-open' or entry['consecutive_failures'] >= failure_threshold:
+            if entry['state'] != 'open':
+                logger.warning("Circuit for %s opened after %s failures", node_id, entry['consecutive_failures'])
+            entry['state'] = 'open'
+            entry['opened_at'] = time.monotonic()
+
+def _probe_due(entry, cooldown, now):
+    """Check whether an open circuit, or a probe that never reported back, allows a new probe. Caller must hold _lock."""
+    return now - entry['opened_at'] >= cooldown
+
+def is_available(node_id, cooldown=60):
+    """
+    Check whether a node may be queried, without changing its circuit.
+
+    An open circuit rejects requests until the cooldown has passed, then lets a
+    single probe request through (half-open) to decide whether to close again.
+    The probe is only claimed by claim_request() when it is actually sent.
+
+    Args:
+        node_id (str): The node to check.
+        cooldown (float): Seconds an open circuit stays open.
+
+    Returns:
+        bool: True if a request to the node should be made.
+    """
+    with _lock:
+        entry = _health.get(node_id)
+        if entry is None or entry['state'] == 'closed':
+            return True
+        return _probe_due(entry, cooldown, time.monotonic())
+
+def claim_request(node_id, cooldown=60):
+    """
+    Claim the right to send a request to a node, right before sending it.
+
+    A node whose cooldown has passed goes half-open and this request is its
+    probe; other requests are refused until the probe reports back through
+    record_success() or record_failure(). A probe that never reports back
+    expires after another cooldown, so the node can't stay half-open forever.
+
+    Returns:
+        bool: True if the request may be sent.
+    """
+    with _lock:
+        entry = _health.get(node_id)
+        if entry is None or entry['state'] == 'closed':
+            return True
+        now = time.monotonic()
+        if not _probe_due(entry, cooldown, now):
+            return False
+        if entry['state'] == 'open':
+            logger.info("Circuit for %s half-open, sending a probe", node_id)
+        entry['state'] = 'half-open'
+        # The probe's expiry is counted from now
+        entry['opened_at'] = now
+        return True
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+def latency_percentile(node_id, pct, default=None):
+    """Return a latency percentile of a node in seconds, or default if it has no samples."""
+    with _lock:
+        entry = _health.get(node_id)
+        if entry is None or not entry['latencies']:
+            return default
+        return _percentile(entry['latencies'], pct)
+
+def rank_nodes(nodes, cooldown=60):
+    """
+    Order the available nodes from most to least promising.
+
+    Nodes with no history come first so they get measured, then nodes by
+    latency EWMA, with error rate as a penalty.
+
+    Args:
+        nodes (iterable): Candidate nodes.
+        cooldown (float): Seconds an open circuit stays open.
+
+    Returns:
+        list: The nodes whose circuit allows a request, best first.
+    """
+    available = [node for node in nodes if is_available(node, cooldown)]
+
+    def score(node):
+        with _lock:
+            entry = _health.get(node)
+            if entry is None or entry['latency_ewma'] is None:
+                return 0.0
+            return entry['latency_ewma'] * (1 + 4 * entry['error_rate'])
+
+    return sorted(available, key=score)
+
+def search_deadline(nodes, max_timeout, factor=2.0, min_timeout=1.0):
+    """
+    Compute how long a fan-out should wait for the given nodes.
+
+    The deadline follows the p95 latency of the slowest healthy node queried,
+    so one slow or flapping peer can't hold every search up to max_timeout.
+
+    Args:
+        nodes (iterable): Nodes being queried.
+        max_timeout (float): Upper bound in seconds.
+        factor (float): Multiplier applied to the p95 latency.
+        min_timeout (float): Lower bound in seconds.
+
+    Returns:
+        float: The deadline in seconds.
+    """
+    p95s = []
+    with _lock:
+        for node in nodes:
+            entry = _health.get(node)
+            if entry is None or (not entry['latencies'] and not entry['errors']):
+                # Nothing known yet, give it the full timeout
+                return max_timeout
+            if entry['state'] == 'closed' and entry['latencies']:
+                p95s.append(_percentile(entry['latencies'], 95))
+
+    if not p95s:
+        return max_timeout
+    return min(max(max(p95s) * factor, min_timeout), max_timeout)
+
+def health_table():
+    """Return the per-node health table, one dictionary per node."""
+    table = []
+    with _lock:
+        for node_id, entry in _health.items():
+            latencies = entry['latencies']
+            table.append({
+                'node_id': node_id,
+                'state': entry['state'],
+                'latency_ewma': entry['latency_ewma'],
+                'latency_p50': _percentile(latencies, 50) if latencies else None,
+                'latency_p95': _percentile(latencies, 95) if latencies else None,
+                'error_rate': entry['error_rate'],
+                'result_yield': entry['yield_ewma'],
+                'requests': entry['requests'],
+                'errors': entry['errors'],
+                'consecutive_failures': entry['consecutive_failures'],
+            })
+    return sorted(table, key=lambda row: row['node_id'])
@@ -1,111 +1,264 @@
+import io
 import os
+import itertools
 import sys
 import subprocess
-import zipfile
-import tarfile
-from PIL import Image, ImageDraw, ImageFont
-import fitz  # PyMuPDF
-from docx import Document
-from pptx import Presentation
-import ebooklib
-from ebooklib import epub
-import matplotlib.pyplot as plt
-from pydub import AudioSegment
 import tempfile
+import logging
+
+# Format handlers import their libraries (Pillow, PyMuPDF, python-docx, python-pptx,
+# ebooklib, NumPy, pydub) on first use, so importing this module stays cheap for
+# processes that never generate a preview.
+
+logger = logging.getLogger(__name__)
+
+# Waveform previews: image size, decode sample rate, and samples decoded per read
+WAVEFORM_SIZE = (512, 256)
+WAVEFORM_SAMPLE_RATE = 8000
+WAVEFORM_BLOCK_SAMPLES = 1 << 18
+# Buckets kept per waveform column before merging them, when the track length is unknown
+WAVEFORM_MAX_BUCKETS_PER_COLUMN = 4
+
+# Preview sizes in pixels, smallest to largest. The largest one is written to the
+# requested output file, the others next to it (see sized_preview_path)
+PREVIEW_SIZES = (64, 256, 512)
+
+def sized_preview_path(output_file, size):
+    """Return where the preview of the given size is stored for an output file"""
+    if size == PREVIEW_SIZES[-1]:
+        return output_file
+    root, ext = os.path.splitext(output_file)
+    return f"{root}-{size}{ext}"
+
+def save_pyramid(img, output_file):
+    """Save an image as WEBP at every preview size, each level downscaled from the one above it"""
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
+    for size in reversed(PREVIEW_SIZES):
+        img.thumbnail((size, size))
+        img.save(sized_preview_path(output_file, size), "WEBP")
+
+# Previews per row of a sprite sheet
+SPRITE_COLUMNS = 10
+
+def sprite_grid(count):
+    """Return the (columns, rows) of a sprite sheet holding `count` previews"""
+    columns = max(min(count, SPRITE_COLUMNS), 1)
+    return columns, max(-(-count // columns), 1)
+
+def build_sprite(preview_files, size):
+    """
+    Combine previews into one sprite sheet.
+
+    Preview i is centered in the size x size cell at column i % SPRITE_COLUMNS,
+    row i // SPRITE_COLUMNS. Missing previews leave their cell blank.
+    """
+    from PIL import Image
+
+    columns, rows = sprite_grid(len(preview_files))
+    sheet = Image.new("RGB", (columns * size, rows * size), (200, 200, 200))
+    for i, preview_file in enumerate(preview_files):
+        if not os.path.exists(preview_file):
+            continue
+        with Image.open(preview_file) as img:
+            x = (i % columns) * size + (size - img.width) // 2
+            y = (i // columns) * size + (size - img.height) // 2
+            sheet.paste(img.convert("RGB"), (x, y))
+    return sheet
 
 def generate_image_preview(input_file, output_file):
     try:
         # Identify the file type based on extension
         file_ext = os.path.splitext(input_file)[1].lower()
 
-        if file_ext in ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff']:
-            # Process image files
-            process_image(input_file, output_file)
-        elif file_ext in ['.mp4', '.mkv', '.avi', '.mov', '.webm']:
-            # Process video files
-            process_video(input_file, output_file)
-        elif file_ext in ['.mp3', '.wav', '.ogg', '.flac']:
-            # Process audio files
-            process_audio(input_file, output_file)
-        elif file_ext == '.pdf':
-            # Process PDF files
-            process_pdf(input_file, output_file)
-        elif file_ext == '.docx':
-            # Process DOCX files
-            process_docx(input_file, output_file)
-        elif file_ext == '.pptx':
-            # Process PPTX files
-            process_pptx(input_file, output_file)
-        elif file_ext == '.epub':
-            # Process EPUB files
-            process_epub(input_file, output_file)
-        elif file_ext in ['.txt', '.md', '.py', '.html', '.css', '.js']:
-            # Process text and code files
-            process_text(input_file, output_file)
-        elif file_ext in ['.zip', '.tar', '.gz']:
-            # Process archive files
-            process_archive(input_file, output_file)
+        handler = PREVIEW_HANDLERS.get(file_ext)
+        if handler:
+            handler(input_file, output_file)
         else:
             # Fallback for unsupported file types
             process_generic_placeholder(output_file)
     except Exception as e:
-        print(f"Error processing file: {e}")
+        logger.error("Error processing file: %s", e)
 
 # ------------------- Helper functions for each format ------------------- #
 
 def process_image(input_file, output_file):
     """Downscale image and save as webp"""
+    from PIL import Image
+
     try:
         with Image.open(input_file) as img:
-            img.thumbnail((512, 512))  # Resize to 512x512 max
-            img.save(output_file, "WEBP")
-        print(f"Image preview saved at {output_file}")
+            # Let the JPEG decoder scale down by up to 8x instead of decoding full resolution
+            img.draft("RGB", (PREVIEW_SIZES[-1], PREVIEW_SIZES[-1]))
+            save_pyramid(img, output_file)
+        logger.debug("Image preview saved at %s", output_file)
     except Exception as e:
-        print(f"Failed to process image: {e}")
+        logger.error("Failed to process image: %s", e)
 
 def process_video(input_file, output_file):
     """Generate a video thumbnail using ffmpegthumbnailer"""
+    from PIL import Image
+
     try:
-        command = ['ffmpegthumbnailer', '-i', input_file, '-o', output_file, '-s', '512', '-f']
-        subprocess.run(command, check=True)
-        print(f"Video preview saved at {output_file}")
+        with tempfile.TemporaryDirectory() as tmp:
+            frame_file = os.path.join(tmp, "frame.png")
+            command = ['ffmpegthumbnailer', '-i', input_file, '-o', frame_file, '-s', str(PREVIEW_SIZES[-1]), '-f']
+            subprocess.run(command, check=True)
+            with Image.open(frame_file) as img:
+                save_pyramid(img, output_file)
+        logger.debug("Video preview saved at %s", output_file)
     except Exception as e:
-        print(f"Failed to process video: {e}")
+        logger.error("Failed to process video: %s", e)
+
+def _audio_duration(input_file):
+    """Return the duration of an audio file in seconds using ffprobe, or None if unknown"""
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+             '-of', 'default=noprint_wrappers=1:nokey=1', input_file],
+            capture_output=True, text=True, check=True
+        )
+        return float(result.stdout.strip())
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return None
+
+def _audio_blocks(input_file, block_samples):
+    """Yield mono float samples in blocks, streamed from ffmpeg, or from pydub if ffmpeg isn't available"""
+    import numpy as np
+
+    try:
+        proc = subprocess.Popen(
+            ['ffmpeg', '-v', 'error', '-i', input_file, '-f', 's16le', '-ac', '1',
+             '-ar', str(WAVEFORM_SAMPLE_RATE), '-'],
+            stdout=subprocess.PIPE
+        )
+    except OSError:
+        from pydub import AudioSegment
+        audio = AudioSegment.from_file(input_file).set_channels(1).set_frame_rate(WAVEFORM_SAMPLE_RATE)
+        samples = np.array(audio.get_array_of_samples(), dtype=np.float32) / float(1 << (8 * audio.sample_width - 1))
+        for start in range(0, len(samples), block_samples):
+            yield samples[start:start + block_samples]
+        return
+
+    try:
+        while True:
+            data = proc.stdout.read(block_samples * 2)
+            if not data:
+                break
+            yield np.frombuffer(data[:len(data) // 2 * 2], dtype='<i2').astype(np.float32) / 32768.0
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+def _audio_envelope(input_file, width):
+    """
+    Compute min/max/RMS per column over the whole track.
+
+    Samples are reduced bucket by bucket as they are decoded. When the length
+    of the track is unknown, buckets are merged pairwise whenever there are
+    more than WAVEFORM_MAX_BUCKETS_PER_COLUMN per column, and later buckets
+    cover twice as many samples, so memory stays bounded by the number of
+    columns no matter how long the track is.
+    """
+    import numpy as np
+
+    duration = _audio_duration(input_file)
+    if duration:
+        bucket_samples = max(int(duration * WAVEFORM_SAMPLE_RATE) // width, 1)
+    else:
+        bucket_samples = WAVEFORM_SAMPLE_RATE  # Unknown length, one bucket per second to start with
+    block_buckets = max(WAVEFORM_BLOCK_SAMPLES // bucket_samples, 1)
+    max_buckets = width * WAVEFORM_MAX_BUCKETS_PER_COLUMN
+
+    mins, maxs, squares, counts = [], [], [], []
+    carry = np.zeros(0, dtype=np.float32)
+
+    def reduce(samples, size):
+        buckets = samples.reshape(-1, size)
+        mins.append(buckets.min(axis=1))
+        maxs.append(buckets.max(axis=1))
+        squares.append(np.square(buckets).sum(axis=1))
+        counts.append(np.full(len(buckets), size))
+
+    def fold():
+        """Merge every pair of buckets into one, an odd last bucket is kept as is."""
+        for parts, merge in ((mins, np.minimum), (maxs, np.maximum), (squares, np.add), (counts, np.add)):
+            values = np.concatenate(parts)
+            paired = len(values) // 2 * 2
+            parts[:] = [merge(values[0:paired:2], values[1:paired:2]), values[paired:]]
+
+    for block in _audio_blocks(input_file, block_buckets * bucket_samples):
+        samples = np.concatenate((carry, block)) if len(carry) else block
+        full = len(samples) // bucket_samples * bucket_samples
+        if full:
+            reduce(samples[:full], bucket_samples)
+        carry = samples[full:]
+        if sum(len(part) for part in mins) > max_buckets:
+            fold()
+            bucket_samples *= 2
+    if len(carry):
+        reduce(carry, len(carry))
+
+    if not mins:
+        raise ValueError("No audio samples decoded")
+
+    mins, maxs = np.concatenate(mins), np.concatenate(maxs)
+    squares, counts = np.concatenate(squares), np.concatenate(counts)
+
+    # Fold the buckets into exactly `width` columns
+    edges = np.linspace(0, len(mins), min(width, len(mins)) + 1).astype(int)[:-1]
+    rms = np.sqrt(np.add.reduceat(squares, edges) / np.add.reduceat(counts, edges))
+    return np.minimum.reduceat(mins, edges), np.maximum.reduceat(maxs, edges), rms
 
 def process_audio(input_file, output_file):
-    """Generate a waveform image from an audio file"""
+    """Generate a waveform image (min/max envelope with RMS band) of the whole track"""
+    import numpy as np
+    from PIL import Image, ImageDraw
+
     try:
-        # Load audio file
-        audio = AudioSegment.from_file(input_file)
-        data = audio.get_array_of_samples()
-
-        # Plot waveform
-        plt.figure(figsize=(8, 4))
-        plt.plot(data[:10000])  # Only plot first 10k samples for preview
-        plt.axis('off')
-        
-        # Save the waveform as an image
-        plt.savefig(output_file, format="webp", bbox_inches='tight', pad_inches=0)
-        plt.close()
-        print(f"Audio preview saved at {output_file}")
+        width, height = WAVEFORM_SIZE
+        mins, maxs, rms = _audio_envelope(input_file, width)
+
+        # Scale to the loudest peak so quiet tracks still fill the image
+        peak = max(float(np.abs(mins).max()), float(np.abs(maxs).max()), 1e-6)
+        mid = height / 2
+        top = (mid - maxs / peak * mid).astype(int)
+        bottom = (mid - mins / peak * mid).astype(int)
+        rms_extent = (rms / peak * mid).astype(int)
+
+        img = Image.new("RGB", (width, height), (255, 255, 255))
+        d = ImageDraw.Draw(img)
+        x_offset = (width - len(mins)) // 2
+        for x in range(len(mins)):
+            d.line([(x + x_offset, top[x]), (x + x_offset, bottom[x])], fill=(120, 160, 220))
+            d.line([(x + x_offset, mid - rms_extent[x]), (x + x_offset, mid + rms_extent[x])], fill=(40, 80, 160))
+        save_pyramid(img, output_file)
+        logger.debug("Audio preview saved at %s", output_file)
     except Exception as e:
-        print(f"Failed to process audio: {e}")
+        logger.error("Failed to process audio: %s", e)
 
 def process_pdf(input_file, output_file):
     """Generate a thumbnail from the first page of a PDF"""
+    import fitz  # PyMuPDF
+    from PIL import Image
+
     try:
         pdf_document = fitz.open(input_file)
         page = pdf_document.load_page(0)  # Get the first page
-        pix = page.get_pixmap()
+        # Rasterize straight at the largest preview size instead of rendering the full page
+        zoom = PREVIEW_SIZES[-1] / max(page.rect.width, page.rect.height)
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
         img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        img.thumbnail((512, 512))
-        img.save(output_file, "WEBP")
-        print(f"PDF preview saved at {output_file}")
+        save_pyramid(img, output_file)
+        logger.debug("PDF preview saved at %s", output_file)
     except Exception as e:
-        print(f"Failed to process PDF: {e}")
+        logger.error("Failed to process PDF: %s", e)
 
 def process_docx(input_file, output_file):
     """Generate a thumbnail from the first page of a DOCX document"""
+    from docx import Document
+    from PIL import Image, ImageDraw
+
     try:
         doc = Document(input_file)
         if doc.paragraphs:
@@ -117,13 +270,16 @@ def process_docx(input_file, output_file):
         img = Image.new("RGB", (512, 512), (255, 255, 255))
         d = ImageDraw.Draw(img)
         d.text((10, 10), text[:200], fill=(0, 0, 0))  # Show the first 200 characters
-        img.save(output_file, "WEBP")
-        print(f"DOCX preview saved at {output_file}")
+        save_pyramid(img, output_file)
+        logger.debug("DOCX preview saved at %s", output_file)
     except Exception as e:
-        print(f"Failed to process DOCX: {e}")
+        logger.error("Failed to process DOCX: %s", e)
 
 def process_pptx(input_file, output_file):
     """Generate a thumbnail from the first slide of a PPTX presentation"""
+    from pptx import Presentation
+    from PIL import Image, ImageDraw
+
     try:
         prs = Presentation(input_file)
         first_slide = prs.slides[0]
@@ -137,13 +293,17 @@ def process_pptx(input_file, output_file):
         img = Image.new("RGB", (512, 512), (255, 255, 255))
         d = ImageDraw.Draw(img)
         d.text((10, 10), title[:200], fill=(0, 0, 0))  # Show the first 200 characters
-        img.save(output_file, "WEBP")
-        print(f"PPTX preview saved at {output_file}")
+        save_pyramid(img, output_file)
+        logger.debug("PPTX preview saved at %s", output_file)
     except Exception as e:
-        print(f"Failed to process PPTX: {e}")
+        logger.error("Failed to process PPTX: %s", e)
 
 def process_epub(input_file, output_file):
     """Generate a thumbnail from an EPUB ebook"""
+    import ebooklib
+    from ebooklib import epub
+    from PIL import Image
+
     try:
         book = epub.read_epub(input_file)
         cover = None
@@ -154,19 +314,19 @@ def process_epub(input_file, output_file):
                 break
 
         if cover:
-            with open(tempfile.mktemp(suffix=".jpg"), 'wb') as f:
-                f.write(cover)
-                img = Image.open(f.name)
-                img.thumbnail((512, 512))
-                img.save(output_file, "WEBP")
+            with Image.open(io.BytesIO(cover)) as img:
+                img.draft("RGB", (PREVIEW_SIZES[-1], PREVIEW_SIZES[-1]))
+                save_pyramid(img, output_file)
         else:
             process_generic_placeholder(output_file)
-        print(f"EPUB preview saved at {output_file}")
+        logger.debug("EPUB preview saved at %s", output_file)
     except Exception as e:
-        print(f"Failed to process EPUB: {e}")
+        logger.error("Failed to process EPUB: %s", e)
 
 def process_text(input_file, output_file):
     """Generate a preview from text or code file"""
+    from PIL import Image, ImageDraw
+
     try:
         with open(input_file, 'r') as f:
             text = f.read(200)  # Read the first 200 characters
@@ -174,41 +334,85 @@ def process_text(input_file, output_file):
         img = Image.new("RGB", (512, 512), (255, 255, 255))
         d = ImageDraw.Draw(img)
         d.text((10, 10), text, fill=(0, 0, 0))
-        img.save(output_file, "WEBP")
-        print(f"Text preview saved at {output_file}")
+        save_pyramid(img, output_file)
+        logger.debug("Text preview saved at %s", output_file)
     except Exception as e:
-        print(f"Failed to process text file: {e}")
+        logger.error("Failed to process text file: %s", e)
+
+def iter_archive_members(input_file):
+    """
+    Yield (name, size) of the files in a zip or tar (optionally compressed) archive.
+
+    Tar archives are read as a stream, so stopping early only reads the archive up
+    to the last member yielded. Zip archives are listed from their central directory.
+    Anything else yields nothing.
+    """
+    import zipfile
+    import tarfile
+
+    if zipfile.is_zipfile(input_file):
+        with zipfile.ZipFile(input_file, 'r') as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    yield info.filename, info.file_size
+        return
+
+    try:
+        with tarfile.open(input_file, 'r|*') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, member.size
+    except tarfile.TarError:
+        return
 
 def process_archive(input_file, output_file):
     """Generate a preview of archive contents"""
+    from PIL import Image, ImageDraw
+
     try:
-        if zipfile.is_zipfile(input_file):
-            with zipfile.ZipFile(input_file, 'r') as archive:
-                file_list = archive.namelist()[:10]  # Show first 10 files
-        elif tarfile.is_tarfile(input_file):
-            with tarfile.open(input_file, 'r') as archive:
-                file_list = [tarinfo.name for tarinfo in archive.getmembers()][:10]
-        else:
-            file_list = []
+        # Stop reading after the first 10 members instead of listing the whole archive
+        file_list = [name for name, _ in itertools.islice(iter_archive_members(input_file), 10)]
 
         img = Image.new("RGB", (512, 512), (255, 255, 255))
         d = ImageDraw.Draw(img)
         d.text((10, 10), "\n".join(file_list), fill=(0, 0, 0))  # Display file names
-        img.save(output_file, "WEBP")
-        print(f"Archive preview saved at {output_file}")
+        save_pyramid(img, output_file)
+        logger.debug("Archive preview saved at %s", output_file)
     except Exception as e:
-        print(f"Failed to process archive: {e}")
+        logger.error("Failed to process archive: %s", e)
 
 def process_generic_placeholder(output_file):
     """Generate a placeholder preview for unsupported file types"""
+    from PIL import Image, ImageDraw
+
     try:
         img = Image.new("RGB", (512, 512), (200, 200, 200))
         d = ImageDraw.Draw(img)
         d.text((100, 250), "Preview Not Available", fill=(0, 0, 0))
-        img.save(output_file, "WEBP")
-        print(f"Generic placeholder saved at {output_file}")
+        save_pyramid(img, output_file)
+        logger.debug("Generic placeholder saved at %s", output_file)
     except Exception as e:
-        print(f"Failed to create placeholder: {e}")
+        logger.error("Failed to create placeholder: %s", e)
+
+# ---------------------------- Handler registry ---------------------------- #
+
+# File extension -> preview handler
+PREVIEW_HANDLERS = {}
+
+def register_handler(extensions, handler):
+    """Register a preview handler for the given file extensions"""
+    for ext in extensions:
+        PREVIEW_HANDLERS[ext] = handler
+
+register_handler(['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff'], process_image)
+register_handler(['.mp4', '.mkv', '.avi', '.mov', '.webm'], process_video)
+register_handler(['.mp3', '.wav', '.ogg', '.flac'], process_audio)
+register_handler(['.pdf'], process_pdf)
+register_handler(['.docx'], process_docx)
+register_handler(['.pptx'], process_pptx)
+register_handler(['.epub'], process_epub)
+register_handler(['.txt', '.md', '.py', '.html', '.css', '.js'], process_text)
+register_handler(['.zip', '.tar', '.gz'], process_archive)
 
 # ---------------------------- Main Execution ---------------------------- #
 
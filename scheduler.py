@@ -1,136 +1,282 @@
-import schedule
 import time
+import random
 import threading
 import logging
 import requests
-from datetime import datetime, timedelta
-from settings import get_setting, return_all, set_setting
-from database import create_sqlite_connection
+from settings import get_setting, set_setting, update_known_nodes
+from database import create_sqlite_connection, init_db
 import peer_discovery
 import indexer
-from colorlog import ColoredFormatter
-
-# Logging configuration
-log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-formatter = ColoredFormatter(
-    "%(asctime)s - %(name)s - %(log_color)s%(levelname)s%(reset)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    log_colors={
-        'DEBUG': 'cyan',
-        'INFO': 'green',
-        'WARNING': 'yellow',
-        'ERROR': 'red',
-        'CRITICAL': 'bold_red',
+import bloom
+import catalog
+import md5_catalog
+
+logger = logging.getLogger(__name__)
+
+# Registered jobs, keyed by name
+_jobs = {}
+_jobs_lock = threading.Lock()
+_scheduler_thread = None
+
+def register_job(name, func, interval, jitter=0.1, first_run=None):
+    """
+    Register a job to run every `interval` seconds.
+
+    Registering a name again updates the existing job instead of adding a
+    second one, so a job can never be scheduled twice.
+
+    Args:
+        name (str): Unique name of the job.
+        func (callable): Function to run, without arguments.
+        interval (float): Seconds between the end of a run and the start of the next.
+        jitter (float): Random spread applied to each interval, as a fraction of it,
+            so nodes started together don't hit their peers at the same moment.
+        first_run (float): Timestamp of the first run, defaults to now.
+    """
+    with _jobs_lock:
+        job = _jobs.get(name)
+        if job is None:
+            job = {
+                'running': False,
+                'runs': 0,
+                'last_run': None,
+                'last_duration': None,
+                'last_error': None,
+                'next_run': first_run if first_run is not None else time.time(),
+            }
+            _jobs[name] = job
+        elif first_run is not None:
+            job['next_run'] = first_run
+        job.update(func=func, interval=interval, jitter=jitter)
+    logger.info("Registered job %s every %s seconds", name, interval)
+
+def _next_delay(job):
+    """Return the interval of a job with jitter applied."""
+    return job['interval'] * (1 + random.uniform(-job['jitter'], job['jitter']))
+
+def _run_job(name):
+    """Run a job once and schedule its next run when it ends."""
+    job = _jobs[name]
+    started = time.time()
+    error = None
+    try:
+        job['func']()
+    except Exception as e:
+        error = str(e)
+        logger.exception("Job %s failed: %s", name, e)
+    finally:
+        duration = time.time() - started
+        with _jobs_lock:
+            job['running'] = False
+            job['runs'] += 1
+            job['last_run'] = started
+            job['last_duration'] = duration
+            job['last_error'] = error
+            job['next_run'] = time.time() + _next_delay(job)
+            first_success = error is None and not job.get('warmed_up')
+            if first_success:
+                job['warmed_up'] = True
+        logger.info("Job %s finished in %.1f seconds", name, duration)
+        if first_success:
+            _record_warmup(name)
+
+def _reset_warmup(names):
+    """Start tracking the warm-up of this node, one step per job."""
+    now = time.time()
+    conn = create_sqlite_connection()
+    try:
+        with conn:
+            conn.execute("DELETE FROM warmup;")
+            conn.executemany("INSERT INTO warmup (name, started_at) VALUES (?, ?);", ((name, now) for name in names))
+    finally:
+        conn.close()
+
+def _record_warmup(name):
+    """Mark the warm-up step of a job as complete."""
+    conn = create_sqlite_connection()
+    try:
+        with conn:
+            conn.execute("UPDATE warmup SET completed_at = ? WHERE name = ? AND completed_at IS NULL;", (time.time(), name))
+    finally:
+        conn.close()
+
+def warmup_status(conn):
+    """
+    Report the warm-up progress of the node.
+
+    Steps are recorded in the database by the process running the jobs, so
+    every worker can answer.
+
+    Returns:
+        dict: 'steps' with the start and completion time of each job's first
+        successful run, and 'complete' telling whether all of them finished.
+    """
+    steps = {
+        name: {'started_at': started_at, 'completed_at': completed_at}
+        for name, started_at, completed_at in conn.execute("SELECT name, started_at, completed_at FROM warmup;")
+    }
+    return {
+        'steps': steps,
+        'complete': bool(steps) and all(step['completed_at'] is not None for step in steps.values()),
     }
-)
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(formatter)
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-logger.addHandler(console_handler)
+
+def job_table():
+    """Return the state of every registered job, one dictionary per job."""
+    with _jobs_lock:
+        return [
+            {
+                'name': name,
+                'interval': job['interval'],
+                'running': job['running'],
+                'runs': job['runs'],
+                'last_run': job['last_run'],
+                'last_duration': job['last_duration'],
+                'last_error': job['last_error'],
+                'next_run': job['next_run'],
+            }
+            for name, job in sorted(_jobs.items())
+        ]
 
 def run_indexer():
     """Runs the indexer task."""
     logger.info("Running indexer...")
     conn = create_sqlite_connection()
-    
-    # Run your actual indexing logic here
-    indexer.indexer(get_setting('DIRECTORY'), conn)
+    try:
+        indexer.indexer(get_setting('DIRECTORY'), conn)
+        # Serve the new files from the in-memory catalog without waiting for its next refresh
+        if get_setting('MEMORY_CATALOG'):
+            md5_catalog.refresh(conn)
+    finally:
+        conn.close()
 
     logger.info("Indexer completed successfully.")
 
-    # Schedule the next run after 24 hours
-    schedule.every(24).hours.do(run_indexer)
-    logger.info("Scheduled indexer for the next run in 24 hours")
-
-def run_announcer():
-    """Runs the announcer task."""
-    logger.info("Running announcer...")
-    known_nodes = get_setting("known_nodes")
-    announced_nodes = set()
-    new_nodes_discovered = False
-
-    for node in known_nodes:
-        if node not in announced_nodes:
-            logger.info(f"Announcing to {node}...")
-            new_nodes = peer_discovery.announce(f"http://{node}/announce", get_setting('NODE_ID'), known_nodes)
-            announced_nodes.add(node)
-            if new_nodes:
-                new_nodes_discovered = True
-                known_nodes.update(new_nodes)
-    set_setting("known_nodes", known_nodes)
-
-    logger.info(f"Known nodes: {known_nodes}")
-    logger.info(f"Announced nodes: {announced_nodes}")
-
-    if not new_nodes_discovered:
-        logger.info("No new nodes discovered, stopping announcer.")
-
-    # Schedule the next run based on the interval set in settings
-    interval = get_setting('PEER_DISCOVER_INTERVAL')
-    schedule.every(interval).hours.do(run_announcer)
-    logger.info(f"Scheduled announcer for the next run in {interval} hours")
+def run_bootstrap():
+    """Fetches the public node list and adds it to the known nodes."""
+    logger.info("Fetching node list...")
+    response = requests.get(get_setting('URL'), timeout=30)
+    if response.status_code == 200:
+        data = response.json()
+        update_known_nodes(added=data)
+        logger.info("Updated known nodes from the URL: %s", get_setting('known_nodes'))
+    else:
+        logger.error("Failed to download node list, status code %s", response.status_code)
+
+def run_gossip():
+    """Exchanges membership changes with a few random live nodes."""
+    logger.info("Running gossip round...")
+    node_id = get_setting('NODE_ID')
+    conn = create_sqlite_connection()
+    try:
+        # Nodes learned from the node list or announcements join the membership
+        peer_discovery.add_seed_nodes(get_setting("known_nodes") - {node_id}, conn)
+        known_nodes = peer_discovery.gossip_round(conn, node_id, get_setting('GOSSIP_FANOUT'),
+                                                  mismatch_threshold=get_setting('GOSSIP_MISMATCH_THRESHOLD'))
+    finally:
+        conn.close()
+
+    if known_nodes != get_setting("known_nodes"):
+        set_setting("known_nodes", known_nodes)
+    logger.info("Known nodes: %s", known_nodes)
 
 def run_heartbeat_checker():
     """Runs the heartbeat checker."""
     logger.info("Running heartbeat checker...")
-    known_nodes = return_all()['known_nodes']
-    nodes_to_remove = set()
-
-    for node in known_nodes:
-        result = peer_discovery.heartbeat_ping(f"http://{node}/heartbeat")
-        if result == 1:
-            logger.info(f"Node {node} is unreachable or invalid, removing from known_nodes.")
-            nodes_to_remove.add(node)
-        elif result == 2:
-            logger.error("No internet connection, cannot perform heartbeat check.")
-            break
-
-    # Update known nodes
-    known_nodes.difference_update(nodes_to_remove)
-    logger.info(f"Updated known nodes: {known_nodes}")
-
-    # Schedule the next run based on the interval set in settings
-    interval = get_setting('HEARTBEAT_INTERVAL')
-    schedule.every(interval).minutes.do(run_heartbeat_checker)
-    logger.info(f"Scheduled heartbeat checker for the next run in {interval} minutes")
+    known_nodes = set(get_setting('known_nodes'))
+    node_id = get_setting('NODE_ID')
+
+    results = peer_discovery.heartbeat_round(
+        {node for node in known_nodes if node and node != node_id},
+        get_setting('HEARTBEAT_WORKERS')
+    )
+    if results is None:
+        logger.error("No internet connection, cannot perform heartbeat check.")
+    else:
+        conn = create_sqlite_connection()
+        try:
+            nodes_to_remove = peer_discovery.update_liveness(results, conn, get_setting('HEARTBEAT_FAILURE_THRESHOLD'))
+            # Let other nodes learn about the eviction through gossip
+            peer_discovery.mark_dead(nodes_to_remove, conn)
+        finally:
+            conn.close()
+
+        for node in nodes_to_remove:
+            logger.info("Node %s missed %s heartbeats, removing from known_nodes.", node, get_setting('HEARTBEAT_FAILURE_THRESHOLD'))
+
+        # Update known nodes
+        if nodes_to_remove:
+            known_nodes.difference_update(nodes_to_remove)
+            update_known_nodes(removed=nodes_to_remove)
+        logger.info("Updated known nodes: %s", known_nodes)
+
+def run_filter_refresher():
+    """Rebuilds the local md5 filter and refreshes the cached filters of known nodes."""
+    logger.info("Refreshing md5 filters...")
+    bloom.refresh_local_filter(get_setting('NODE_ID'), get_setting('BLOOM_ERROR_RATE'))
+    bloom.fetch_peer_filters(set(get_setting("known_nodes")), get_setting('NODE_ID'))
+    logger.info("md5 filters refreshed.")
+
+def run_catalog_sync():
+    """Pulls catalog changes from known nodes into the local replica."""
+    logger.info("Syncing peer catalogs...")
+    catalog.sync_catalogs(set(get_setting("known_nodes")), get_setting('NODE_ID'))
+    logger.info("Peer catalogs synced.")
+
+def run_memory_catalog():
+    """Merges index changes into the in-memory md5 catalog shared by the workers."""
+    conn = create_sqlite_connection()
+    try:
+        md5_catalog.refresh(conn)
+    finally:
+        conn.close()
 
 def schedule_tasks():
-    """Schedules all tasks."""
-    # Schedule the indexer for the first time
-    index_time = get_setting('INDEX_FILES_TIME')
-    next_index_run = datetime.now().replace(hour=index_time, minute=0, second=0, microsecond=0)
-    if datetime.now() > next_index_run:
-        next_index_run += timedelta(days=1)
+    """Registers all jobs."""
+    # Tables added since the database was created must exist before any job runs
+    init_db()
 
-    delay_index = (next_index_run - datetime.now()).total_seconds()
-    logger.info(f"Scheduled indexer for {next_index_run} (in {delay_index // 3600} hours and {(delay_index % 3600) // 60} minutes)")
+    # Index right away, then every 24 hours
+    register_job('indexer', run_indexer, 24 * 3600, jitter=0)
 
-    # Run the indexer immediately
-    run_indexer()
+    register_job('bootstrap', run_bootstrap, 24 * 3600)
+    register_job('gossip', run_gossip, get_setting('GOSSIP_INTERVAL'))
+    register_job('heartbeat', run_heartbeat_checker, get_setting('HEARTBEAT_INTERVAL') * 60)
 
-    # Fetch known nodes from the URL and update settings
-    response = requests.get(get_setting('URL'))
-    if response.status_code == 200:
-        data = response.json()
-        current_known_nodes = return_all()['known_nodes']
-        current_known_nodes.update(data)
-        logger.info(f"Updated known nodes from the URL: {current_known_nodes}")
-    else:
-        logger.error(f"Failed to download node list, status code {response.status_code}")
+    # Keep md5 filters fresh so md5 lookups only go to nodes that may have the file
+    register_job('filter_refresher', run_filter_refresher, get_setting('BLOOM_REFRESH_INTERVAL') * 60)
 
-    # Run announcer and heartbeat checker immediately
-    run_announcer()
-    run_heartbeat_checker()
+    # Replicate peer catalogs so most searches can be answered locally
+    if get_setting('CATALOG_REPLICATION'):
+        register_job('catalog_sync', run_catalog_sync, get_setting('CATALOG_SYNC_INTERVAL') * 60)
+
+    # Resolve downloads and md5 lookups from a compact catalog mapped by every worker
+    if get_setting('MEMORY_CATALOG'):
+        register_job('memory_catalog', run_memory_catalog, get_setting('MEMORY_CATALOG_INTERVAL'))
+
+    # The node is warmed up once every job has completed its first run
+    with _jobs_lock:
+        names = list(_jobs)
+    _reset_warmup(names)
 
 def _run_scheduler():
     """Internal function to run the scheduler."""
     while True:
-        schedule.run_pending()
+        now = time.time()
+        with _jobs_lock:
+            # A job still running is skipped, so runs of the same job never overlap
+            due = [name for name, job in _jobs.items() if not job['running'] and job['next_run'] <= now]
+            for name in due:
+                _jobs[name]['running'] = True
+
+        # Each run gets its own thread, so a long indexer run can't delay heartbeats
+        for name in due:
+            threading.Thread(target=_run_job, args=(name,), name=f"job-{name}", daemon=True).start()
         time.sleep(1)
 
 def start_scheduler():
     """Start the task scheduler in a background thread."""
-    scheduler_thread = threading.Thread(target=_run_scheduler, daemon=True)
-    scheduler_thread.start()
-
+    global _scheduler_thread
+    if _scheduler_thread is not None and _scheduler_thread.is_alive():
+        return
+    _scheduler_thread = threading.Thread(target=_run_scheduler, name="scheduler", daemon=True)
+    _scheduler_thread.start()
@@ -1,30 +1,157 @@
 import sqlite3
 import os
+import math
+import heapq
+import time
+import uuid
+import random
 import requests
 import logging
-from colorlog import ColoredFormatter
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from previews import generate_image_preview
-
-# Logging configuration
-log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-formatter = ColoredFormatter(
-    "%(asctime)s - %(name)s - %(log_color)s%(levelname)s%(reset)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    log_colors={
-        'DEBUG': 'cyan',
-        'INFO': 'green',
-        'WARNING': 'yellow',
-        'ERROR': 'red',
-        'CRITICAL': 'bold_red',
-    }
-)
-
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(formatter)
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-logger.addHandler(console_handler)
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED, TimeoutError
+from previews import generate_image_preview, sprite_grid
+from settings import get_setting
+import bloom
+import catalog
+import md5_catalog
+import peer_health
+
+logger = logging.getLogger(__name__)
+
+# Share of its own timeout a node gives the next hop of a forwarded query
+FORWARD_TIMEOUT_FACTOR = 0.7
+
+# Preview size linked from search results, see previews.PREVIEW_SIZES
+RESULT_PREVIEW_SIZE = 256
+
+# Maximum number of previews in one sprite sheet
+SPRITE_MAX = 100
+
+# Media type of the compact columnar /localsearch response, negotiated with the Accept header
+COLUMNAR_MIMETYPE = "application/x-0din-columnar+json"
+
+def local_protocol():
+    """Return the protocol this node serves downloads and previews over."""
+    if os.getenv("ENABLE_SSL") == "true" or os.getenv("ENABLE_HTTPS_REDIRECT") == "true":
+        return "https"
+    return "http"
+
+def preview_name(md5_hash):
+    """Return the name of the preview image generated for a file, named by content so it never changes."""
+    return f"{md5_hash}.webp"
+
+def file_urls(protocol, node_id, md5_hash):
+    """
+    Build the download and preview URLs of a file hosted on a node.
+
+    Returns:
+        tuple: (download_url, preview_url), the preview at the size used by result pages
+    """
+    return (
+        f"{protocol}://{node_id}/download/{md5_hash}",
+        f"{protocol}://{node_id}/preview/{preview_name(md5_hash)}?size={RESULT_PREVIEW_SIZE}",
+    )
+
+def attach_sprites(results, display_size):
+    """
+    Point each result at its cell in a per-node preview sprite sheet.
+
+    Results hosted on the same node share one /preview_sprite request (split
+    every SPRITE_MAX results), so a result page needs about one preview request
+    per node instead of one per result.
+
+    Args:
+        results (list): Merged search results, updated in place with a 'sprite' entry.
+        display_size (int): Size in pixels each preview is displayed at.
+    """
+    by_node = {}
+    for result in results:
+        by_node.setdefault(result['download_url'].split('/download/', 1)[0], []).append(result)
+
+    for base_url, node_results in by_node.items():
+        for start in range(0, len(node_results), SPRITE_MAX):
+            batch = node_results[start:start + SPRITE_MAX]
+            columns, rows = sprite_grid(len(batch))
+            url = f"{base_url}/preview_sprite?size={RESULT_PREVIEW_SIZE}&md5={','.join(r['md5_hash'] for r in batch)}"
+            for i, result in enumerate(batch):
+                result['sprite'] = {
+                    'url': url,
+                    'x': (i % columns) * display_size,
+                    'y': (i // columns) * display_size,
+                    'width': columns * display_size,
+                    'height': rows * display_size,
+                }
+
+def encode_columnar(matches):
+    """
+    Encode search matches in the compact columnar format used between nodes.
+
+    Each field is sent once as a column instead of once per row. Node IDs and
+    their protocols are listed once and referenced by index, and the URLs and
+    local paths are left out since the caller rebuilds the URLs with decode_columnar().
+
+    Args:
+        matches (list): Matches as returned by local_search(), possibly from several nodes.
+
+    Returns:
+        dict: The columnar payload.
+    """
+    nodes = []
+    protocols = []
+    node_index = {}
+    columns = {'file_name': [], 'md5_hash': [], 'file_size': [], 'category': [], 'download_count': [], 'node': []}
+    for match in matches:
+        node_id = match['node_id']
+        if node_id not in node_index:
+            node_index[node_id] = len(nodes)
+            nodes.append(node_id)
+            protocols.append(match['download_url'].split('://', 1)[0])
+        columns['node'].append(node_index[node_id])
+        for key in ('file_name', 'md5_hash', 'file_size', 'category', 'download_count'):
+            columns[key].append(match[key])
+    return {'nodes': nodes, 'protocols': protocols, 'columns': columns}
+
+def decode_columnar(payload, node_id=None):
+    """
+    Rebuild row matches, including their URLs, from a columnar payload.
+
+    Args:
+        payload (dict): The columnar payload.
+        node_id (str, optional): Address the payload was fetched from. When given, every
+            row is attributed to it instead of the node's self-reported ID.
+    """
+    nodes = [node_id] * len(payload['nodes']) if node_id else payload['nodes']
+    protocols = payload['protocols']
+    columns = payload['columns']
+    matches = []
+    for file_name, md5_hash, file_size, category, download_count, node in zip(
+        columns['file_name'], columns['md5_hash'], columns['file_size'],
+        columns['category'], columns['download_count'], columns['node']
+    ):
+        node_id = nodes[node]
+        download_url, preview_url = file_urls(protocols[node], node_id, md5_hash)
+        matches.append({
+            'file_name': file_name,
+            'md5_hash': md5_hash,
+            'file_size': file_size,
+            'category': category,
+            'download_count': download_count,
+            'node_id': node_id,
+            'download_url': download_url,
+            'preview_url': preview_url,
+        })
+    return matches
+
+def _catalog_rules_out(search_term, search_type, category):
+    """
+    Check the in-memory catalog for searches that can't match any local file.
+
+    Returns:
+        bool: True if the md5 isn't indexed here or no local file has the category.
+    """
+    if search_type == 'md5' and md5_catalog.contains(search_term) is False:
+        return True
+    counts = md5_catalog.category_counts() if category else None
+    return counts is not None and not counts.get(category)
 
 def local_search(search_term, node_id, conn, search_type='name', category=None):
     """
@@ -40,33 +167,38 @@ def local_search(search_term, node_id, conn, search_type='name', category=None):
         list: A list of dictionaries matching the search term and category (if specified), with 'node_id' included.
     """
     matches = []
+    if get_setting('MEMORY_CATALOG') and _catalog_rules_out(search_term, search_type, category):
+        conn.close()
+        return matches
+
     cursor = conn.cursor()
 
     try:
-        logger.debug(f"Starting local search: search_term={search_term}, search_type={search_type}, category={category}")
+        logger.debug("Starting local search: search_term=%s, search_type=%s, category=%s", search_term, search_type, category)
 
         # Create the SQL query to include download_count
         query = "SELECT file_name, path, md5_hash, file_size, category, download_count FROM files WHERE"
         conditions = []
+        params = []
         if category:
-            conditions.append(" category = %s")
+            conditions.append(" category = ?")
+            params.append(category)
         if search_type == 'name':
-            conditions.append(" LOWER(file_name) LIKE LOWER(%s)")
-            search_term = f"%{search_term}%"
+            # Archives also match on the names of the files they contain
+            conditions.append(" (LOWER(file_name) LIKE LOWER(?) OR md5_hash IN"
+                              " (SELECT archive_md5 FROM archive_members WHERE LOWER(member_name) LIKE LOWER(?)))")
+            params.extend([f"%{search_term}%"] * 2)
         elif search_type == 'md5':
-            conditions.append(" md5_hash = %s")
+            conditions.append(" md5_hash = ?")
+            params.append(search_term)
 
         query += " AND".join(conditions)
 
         # Execute the query
-        cursor.execute(query, tuple([category, search_term] if category else [search_term]))
+        cursor.execute(query, params)
         results = cursor.fetchall()
 
-        # Determine the protocol for download URLs
-        if os.getenv("ENABLE_SSL") == "true" or os.getenv("ENABLE_HTTPS_REDIRECT") == "true":
-            protocol = "https"
-        else:
-            protocol = "http"
+        protocol = local_protocol()
 
         # Create a hidden directory for previews
         shared_directory = os.getenv("SHARED_DIRECTORY")
@@ -80,15 +212,17 @@ def local_search(search_term, node_id, conn, search_type='name', category=None):
             md5_hash = row[2]
 
             # Generate the preview file name
-            preview_file_name = f"{os.path.splitext(file_name)[0]} - preview.webp"
+            preview_file_name = preview_name(md5_hash)
             output_file_path = os.path.join(hidden_directory, preview_file_name)
 
-            # Generate the image preview
-            try:
-                generate_image_preview(file_path, output_file_path)
-            except Exception as e:
-                logger.error(f"Failed to generate preview for {file_name}: {e}")
+            # Generate the image previews, once: they are named by md5 so they never go stale
+            if not os.path.exists(output_file_path):
+                try:
+                    generate_image_preview(file_path, output_file_path)
+                except Exception as e:
+                    logger.error("Failed to generate preview for %s: %s", file_name, e)
 
+            download_url, preview_url = file_urls(protocol, node_id, md5_hash)
             match = {
                 'file_name': file_name,
                 'path': file_path,
@@ -97,21 +231,298 @@ def local_search(search_term, node_id, conn, search_type='name', category=None):
                 'category': row[4],
                 'download_count': row[5],  # Added download_count to the result
                 'node_id': node_id,
-                'download_url': f"{protocol}://{node_id}/download/{md5_hash}",
-                'preview_url': f"{protocol}://{node_id}/previews/.previews/{preview_file_name}"  # Assuming you have a way to serve these previews
+                'download_url': download_url,
+                'preview_url': preview_url,
             }
             matches.append(match)
 
-        logger.info(f"Local search completed. Found {len(matches)} matches.")
+        logger.debug("Local search completed. Found %s matches.", len(matches))
     except Exception as e:
-        logger.error(f"Error during local search: {e}")
+        logger.error("Error during local search: %s", e)
     finally:
         cursor.close()
         conn.close()
 
     return matches
 
-def global_search(search_term, known_nodes, current_node_id, conn, search_type='name', category=None):
+def replica_search(search_term, fresh_nodes, conn, search_type='name', category=None):
+    """
+    Search the local replica of peer catalogs.
+
+    Args:
+        search_term (str): Term to search for in file names or md5_hash.
+        fresh_nodes (dict): Protocol of each node whose replica may be used, keyed by node_id.
+        conn (sqlite3.Connection): Connection to the local index.
+        search_type (str): The type of search to perform ('name' for file name, 'md5' for md5_hash).
+        category (str, optional): Category to filter the search results by.
+
+    Returns:
+        list: Matches in the same form as remote /localsearch results.
+    """
+    if not fresh_nodes:
+        return []
+
+    query = "SELECT node_id, file_name, md5_hash, file_size, category, download_count FROM replica_files WHERE"
+    params = []
+    conditions = [f" node_id IN ({', '.join('?' * len(fresh_nodes))})"]
+    params.extend(fresh_nodes)
+    if category:
+        conditions.append(" category = ?")
+        params.append(category)
+    if search_type == 'name':
+        conditions.append(" LOWER(file_name) LIKE LOWER(?)")
+        params.append(f"%{search_term}%")
+    elif search_type == 'md5':
+        conditions.append(" md5_hash = ?")
+        params.append(search_term)
+    query += " AND".join(conditions)
+
+    matches = []
+    for node_id, file_name, md5_hash, file_size, file_category, download_count in conn.execute(query, params):
+        download_url, preview_url = file_urls(fresh_nodes[node_id], node_id, md5_hash)
+        matches.append({
+            'file_name': file_name,
+            'md5_hash': md5_hash,
+            'file_size': file_size,
+            'category': file_category,
+            'download_count': download_count,
+            'node_id': node_id,
+            'download_url': download_url,
+            'preview_url': preview_url,
+        })
+    logger.info("Replica search found %s matches from %s nodes", len(matches), len(fresh_nodes))
+    return matches
+
+def replica_max_age():
+    """Age in seconds after which a node's replica is too stale to answer searches."""
+    return get_setting('CATALOG_SYNC_INTERVAL') * 60 * 3
+
+def filter_max_age():
+    """Age in seconds after which a cached md5 filter is no longer trusted."""
+    return get_setting('BLOOM_REFRESH_INTERVAL') * 60 * 3
+
+def merge_matches(merged, matches):
+    """
+    Fold a batch of matches into the merged results, collapsing files by md5_hash.
+
+    Every node hosting a file is listed in the entry's 'sources', and its download
+    counts are summed so popularity reflects the whole network.
+
+    Args:
+        merged (dict): Merged results keyed by md5_hash, updated in place.
+        matches (list): Matches from one node.
+    """
+    for match in matches:
+        source = {
+            'node_id': match.get('node_id'),
+            'download_url': match.get('download_url'),
+            'preview_url': match.get('preview_url'),
+        }
+        entry = merged.get(match['md5_hash'])
+        if entry is None:
+            entry = dict(match)
+            entry['download_count'] = match.get('download_count') or 0
+            entry['sources'] = [source]
+            merged[match['md5_hash']] = entry
+        else:
+            entry['download_count'] += match.get('download_count') or 0
+            entry['sources'].append(source)
+
+def top_matches(merged, limit):
+    """Return the `limit` most downloaded merged results, most downloaded first."""
+    return heapq.nlargest(limit, merged.values(), key=lambda x: x['download_count'])
+
+def query_node(node_id, payload, timeout=None):
+    """
+    Send a search request to a node's /localsearch endpoint and record how it went.
+
+    Args:
+        node_id (str): The node to query.
+        payload (dict): The search request body.
+        timeout (float, optional): Request timeout in seconds, defaults to the SEARCH_TIMEOUT setting.
+
+    Returns:
+        list: The node's matches, or an empty list if the request failed.
+    """
+    # Ranking only reads circuits, the probe of a half-open node is claimed when it is sent
+    if not peer_health.claim_request(node_id, get_setting('CIRCUIT_COOLDOWN')):
+        logger.debug("Circuit for %s is open, not querying it", node_id)
+        return []
+
+    search_url = f"http://{node_id}/localsearch"
+    start = time.monotonic()
+    try:
+        logger.debug("Sending remote search request to %s", search_url)
+        # Ask for the compact format, nodes that don't support it answer with plain JSON
+        response = requests.post(search_url, json=payload, timeout=timeout or get_setting('SEARCH_TIMEOUT'), verify=False, headers={
+            "Accept": f"{COLUMNAR_MIMETYPE}, application/json;q=0.5",
+            "Accept-Encoding": "gzip, deflate",
+        })
+        response.raise_for_status()
+        # Rows of a direct query all come from the node contacted, whose self-reported NODE_ID may
+        # be a default like 127.0.0.1:5000, so its address is used instead. Forwarded queries return
+        # rows from other nodes too, which keep the IDs they were reported with.
+        contacted = node_id if 'query_id' not in payload else None
+        if response.headers.get("Content-Type", "").startswith(COLUMNAR_MIMETYPE):
+            remote_matches = decode_columnar(response.json(), contacted)
+        else:
+            remote_matches = response.json()
+            if contacted:
+                for match in remote_matches:
+                    match['node_id'] = contacted
+                    match['download_url'], match['preview_url'] = file_urls(
+                        match['download_url'].split('://', 1)[0], contacted, match['md5_hash']
+                    )
+    except (requests.RequestException, ValueError, KeyError, IndexError, TypeError) as e:
+        logger.error("Error during search on node %s: %s", node_id, e)
+        peer_health.record_failure(node_id, get_setting('CIRCUIT_FAILURE_THRESHOLD'))
+        return []
+
+    peer_health.record_success(node_id, time.monotonic() - start, len(remote_matches))
+    logger.debug("Received %s matches from node %s", len(remote_matches), node_id)
+    return remote_matches
+
+def hedged_md5_lookup(md5_hash, nodes):
+    """
+    Find one node that hosts an md5 hash, hedging against slow replicas.
+
+    The best ranked node is asked first. If it hasn't answered within its median
+    latency, the next one is asked too, and so on, so a single slow node doesn't
+    decide how long the lookup takes.
+
+    Args:
+        md5_hash (str): The md5 hash to look up.
+        nodes (list): Nodes that may host the hash.
+
+    Returns:
+        str: The first node confirming it hosts the hash, or None.
+    """
+    payload = {"search_term": md5_hash, "search_type": "md5", "category": None}
+    remaining = peer_health.rank_nodes(nodes, get_setting('CIRCUIT_COOLDOWN'))
+    executor = ThreadPoolExecutor(max_workers=max(len(remaining), 1))
+    pending = {}
+    try:
+        while remaining or pending:
+            if remaining:
+                node_id = remaining.pop(0)
+                pending[executor.submit(query_node, node_id, payload)] = node_id
+                hedge_delay = peer_health.latency_percentile(node_id, 50, get_setting('HEDGE_DELAY'))
+            else:
+                hedge_delay = None
+
+            done, _ = wait(pending, timeout=hedge_delay, return_when=FIRST_COMPLETED)
+            for future in done:
+                node_id = pending.pop(future)
+                if future.result():
+                    return node_id
+        return None
+    finally:
+        executor.shutdown(wait=False)
+
+def fan_out(nodes, payload, deadline, timeout=None):
+    """
+    Query nodes concurrently and yield each node's matches as they arrive.
+
+    Args:
+        nodes (list): Nodes to query.
+        payload (dict): The search request body.
+        deadline (float): Seconds to wait for answers before giving up on the rest.
+        timeout (float, optional): Per request timeout in seconds.
+
+    Yields:
+        list: The matches of one node.
+    """
+    executor = ThreadPoolExecutor()
+    futures = {executor.submit(query_node, node_id, payload, timeout): node_id for node_id in nodes}
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            yield future.result()
+    except TimeoutError:
+        late = [futures[future] for future in futures if not future.done()]
+        logger.warning("Search deadline of %.2fs passed, not waiting for %s", deadline, late)
+    finally:
+        # Stragglers finish in the background and still update peer health
+        executor.shutdown(wait=False)
+
+def select_neighbors(nodes, fanout):
+    """
+    Pick at most `fanout` nodes to forward a query to.
+
+    Neighbors are drawn at random among the nodes whose circuit is closed, so
+    successive queries spread over the network instead of always taking the same path.
+    """
+    available = peer_health.rank_nodes(nodes, get_setting('CIRCUIT_COOLDOWN'))
+    return random.sample(available, min(fanout, len(available)))
+
+def mark_query_seen(query_id, conn, max_age=600):
+    """
+    Remember a forwarded query so it is answered only once per node.
+
+    The query ID is recorded in SQLite, so every worker of the node shares it.
+
+    Args:
+        query_id (str): ID of the forwarded query.
+        conn (sqlite3.Connection): Connection to the local index.
+        max_age (float): Seconds after which query IDs are forgotten.
+
+    Returns:
+        bool: True if the query is new, False if it was already seen.
+    """
+    now = time.time()
+    conn.execute("DELETE FROM seen_queries WHERE seen_at < ?;", (now - max_age,))
+    cursor = conn.execute("INSERT OR IGNORE INTO seen_queries (query_id, seen_at) VALUES (?, ?);", (query_id, now))
+    conn.commit()
+    return cursor.rowcount == 1
+
+def _peer_number(value, cast, default, maximum):
+    """
+    Read a number from a peer's request, which may be missing or malformed.
+
+    Returns:
+        The number clamped to [0, maximum], or default if it isn't a finite number.
+    """
+    try:
+        value = cast(value)
+    except (TypeError, ValueError, OverflowError):
+        return default
+    if not math.isfinite(value):
+        return default
+    return min(max(value, 0), maximum)
+
+def forward_search(data, known_nodes, current_node_id):
+    """
+    Forward a search received through /localsearch to a bounded set of neighbors.
+
+    The query keeps its ID so nodes reached through several paths answer once,
+    and every hop decrements its TTL and shrinks its timeout so answers come
+    back up the tree before the parent stops waiting.
+
+    Args:
+        data (dict): The received search request, with 'query_id', 'ttl' and 'timeout'.
+        known_nodes (set): Nodes known to the current node.
+        current_node_id (str): The ID of the current node.
+
+    Returns:
+        list: Matches collected from the neighbors and the nodes they forwarded to.
+    """
+    # ttl and timeout come from another node: a malformed or huge value must not fail or flood the search
+    ttl = _peer_number(data.get('ttl'), int, 0, get_setting('SEARCH_MAX_TTL'))
+    if ttl <= 0:
+        return []
+
+    search_timeout = get_setting('SEARCH_TIMEOUT')
+    timeout = _peer_number(data.get('timeout'), float, search_timeout, search_timeout) * FORWARD_TIMEOUT_FACTOR
+    candidates = [node for node in known_nodes if node and node not in (current_node_id, data.get('sender'))]
+    neighbors = select_neighbors(candidates, get_setting('SEARCH_FANOUT'))
+    payload = dict(data, ttl=ttl - 1, timeout=timeout * FORWARD_TIMEOUT_FACTOR, sender=current_node_id)
+
+    logger.debug("Forwarding query %s with ttl %s to %s", data['query_id'], ttl - 1, neighbors)
+    matches = []
+    for remote_matches in fan_out(neighbors, payload, timeout, timeout):
+        matches.extend(remote_matches)
+    return matches
+
+def global_search(search_term, known_nodes, current_node_id, conn, search_type='name', category=None, limit=None):
     """
     Perform a global search across all known nodes and the local index in the PostgreSQL database.
 
@@ -121,51 +532,56 @@ def global_search(search_term, known_nodes, current_node_id, conn, search_type='
         current_node_id (str): The ID of the current node performing the search.
         search_type (str): The type of search to perform ('name' for file name, 'md5' for md5_hash).
         category (str, optional): Category to filter the search results by.
+        limit (int, optional): Maximum number of results, defaults to the SEARCH_RESULT_LIMIT setting.
 
     Returns:
-        list: A combined list of dictionaries from both local and remote searches, sorted by download_count in descending order.
+        list: Local and remote matches collapsed by md5_hash, each listing its 'sources',
+        the top `limit` of them sorted by download_count in descending order.
     """
-    global_matches = []
+    merged = {}
+    if limit is None:
+        limit = get_setting('SEARCH_RESULT_LIMIT')
+
+    logger.debug("Initiating global search for term '%s' on node '%s'", search_term, current_node_id)
+
+    remote_nodes = [node_id for node_id in known_nodes if node_id != current_node_id]
+    if get_setting('CATALOG_REPLICATION'):
+        # Answer for freshly replicated nodes locally, only the rest are asked live
+        fresh_nodes = {node: protocol for node, protocol in catalog.fresh_replicas(conn, replica_max_age()).items()
+                       if node in remote_nodes}
+        merge_matches(merged, replica_search(search_term, fresh_nodes, conn, search_type, category))
+        remote_nodes = [node_id for node_id in remote_nodes if node_id not in fresh_nodes]
+
+    if search_type == 'md5':
+        # Only ask nodes whose md5 filter may contain the hash, and nodes we have no fresh filter for
+        matched, unknown = bloom.candidate_nodes(search_term, remote_nodes, conn, filter_max_age())
+        logger.debug("md5 filters matched %s of %s nodes, %s without a filter", len(matched), len(remote_nodes), len(unknown))
+        remote_nodes = matched + unknown
+
+    payload = {"search_term": search_term, "search_type": search_type, "category": category}
+    if get_setting('SEARCH_ROUTING') == 'forward' and search_type == 'name':
+        # Ask a bounded set of neighbors, which forward the query on until its TTL runs out
+        remote_nodes = select_neighbors(remote_nodes, get_setting('SEARCH_FANOUT'))
+        deadline = get_setting('SEARCH_TIMEOUT')
+        payload.update(query_id=uuid.uuid4().hex, ttl=get_setting('SEARCH_TTL'),
+                       timeout=deadline * FORWARD_TIMEOUT_FACTOR, sender=current_node_id)
+        # Don't answer our own query if a neighbor forwards it back
+        mark_query_seen(payload['query_id'], conn)
+    else:
+        # Skip nodes whose circuit is open, best performing nodes first
+        remote_nodes = peer_health.rank_nodes(remote_nodes, get_setting('CIRCUIT_COOLDOWN'))
+        deadline = peer_health.search_deadline(remote_nodes, get_setting('SEARCH_TIMEOUT'))
 
-    logger.debug(f"Initiating global search for term '{search_term}' on node '{current_node_id}'")
-    
     # Perform local search
     local_matches = local_search(search_term, current_node_id, conn, search_type, category)
-    global_matches.extend(local_matches)
-
-    def remote_search(node_id):
-        """Performs the remote search request."""
-        if node_id == current_node_id:
-            return []  # Skip the current node
-        try:
-            search_url = f"http://{node_id}/localsearch"
-            logger.debug(f"Sending remote search request to {search_url}")
-            response = requests.post(search_url, json={
-                "search_term": search_term,
-                "search_type": search_type,
-                "category": category
-            }, verify=False)
-            response.raise_for_status()
-            remote_matches = response.json()
-            for match in remote_matches:
-                match['node_id'] = node_id
-            logger.info(f"Received {len(remote_matches)} matches from node {node_id}")
-            return remote_matches
-        except requests.RequestException as e:
-            logger.error(f"Error during global search on node {node_id}: {e}")
-            return []
-
-    # Use ThreadPoolExecutor to perform remote searches concurrently
-    with ThreadPoolExecutor() as executor:
-        futures = {executor.submit(remote_search, node_id): node_id for node_id in known_nodes if node_id != current_node_id}
-
-        for future in as_completed(futures):
-            remote_matches = future.result()
-            global_matches.extend(remote_matches)
-
-    # Sort global matches by download_count in descending order
-    global_matches = sorted(global_matches, key=lambda x: x.get('download_count', 0), reverse=True)
-
-    logger.info(f"Global search completed. Total matches found: {len(global_matches)}")
+    merge_matches(merged, local_matches)
+
+    # Merge each node's results as they arrive instead of concatenating them all first
+    for remote_matches in fan_out(remote_nodes, payload, deadline):
+        merge_matches(merged, remote_matches)
+
+    global_matches = top_matches(merged, limit)
+
+    logger.info("Global search completed. %s distinct files found, returning %s", len(merged), len(global_matches))
     return global_matches
 
@@ -1,25 +1,86 @@
 import json
 import os
+import sqlite3
+import threading
+from database import DB_PATH, init_db
 
-# Define the path to the settings JSON file
+# Settings file of older versions, imported into the database on first start
 SETTINGS_FILE = 'settings.json'
 
 # This dictionary will hold the settings in memory
 settings = {}
 
+# Settings are shared by every gunicorn worker through the database; each
+# process keeps one connection and a cached copy it refreshes on change.
+_lock = threading.RLock()
+_conn = None
+_data_version = None
+_settings_version = None
+
+def _connection():
+    """Return the settings connection of this process, creating the tables on first use."""
+    global _conn
+    if _conn is None:
+        init_db()
+        _conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    return _conn
+
+def _import_settings_file(conn):
+    """Copy settings.json into the database if the database has no settings yet."""
+    if not os.path.exists(SETTINGS_FILE) or conn.execute("SELECT 1 FROM settings LIMIT 1;").fetchone():
+        return
+    with open(SETTINGS_FILE, 'r') as f:
+        stored = json.load(f)
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO known_nodes (node_id) VALUES (?);",
+            ((node,) for node in stored.pop('known_nodes', []) if node)
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?);",
+            ((key, json.dumps(value)) for key, value in stored.items())
+        )
+        conn.execute("UPDATE settings_meta SET version = version + 1;")
+
+def _reload(conn):
+    """Replace the cached settings with the database contents."""
+    global settings, _settings_version
+    _settings_version = conn.execute("SELECT version FROM settings_meta;").fetchone()[0]
+    stored = {key: json.loads(value) for key, value in conn.execute("SELECT key, value FROM settings;")}
+    # Fill in defaults for settings that were never changed
+    settings = {**get_default_settings(), **stored}
+    settings['known_nodes'] = {node for (node,) in conn.execute("SELECT node_id FROM known_nodes;")}
+
+def _refresh_if_changed():
+    """
+    Reload the cached settings if another process changed them.
+
+    PRAGMA data_version only changes when another connection commits, so the
+    common case costs no query on the settings tables at all.
+    """
+    global _data_version
+    conn = _connection()
+    data_version = conn.execute("PRAGMA data_version;").fetchone()[0]
+    if data_version == _data_version:
+        return
+    _data_version = data_version
+    if conn.execute("SELECT version FROM settings_meta;").fetchone()[0] != _settings_version:
+        _reload(conn)
+
 def load_settings():
-    """Load settings from the JSON file."""
-    global settings
-    if os.path.exists(SETTINGS_FILE):
-        with open(SETTINGS_FILE, 'r') as f:
-            settings = json.load(f)
-        # Convert 'known_nodes' back to a set if it exists
-        if 'known_nodes' in settings:
-            settings['known_nodes'] = set(settings['known_nodes'])
-    else:
-        # If the file doesn't exist, initialize with default settings
-        settings = get_default_settings()
-        _save_settings()
+    """Load settings from the database, importing settings.json on first start."""
+    global _data_version
+    with _lock:
+        conn = _connection()
+        _import_settings_file(conn)
+        if not conn.execute("SELECT 1 FROM known_nodes LIMIT 1;").fetchone():
+            with conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO known_nodes (node_id) VALUES (?);",
+                    ((node,) for node in get_default_settings()['known_nodes'] if node)
+                )
+        _data_version = conn.execute("PRAGMA data_version;").fetchone()[0]
+        _reload(conn)
 
 def get_default_settings():
     """Return default settings."""
@@ -27,35 +88,114 @@ def get_default_settings():
         'NODE_ID': os.getenv('NODE_ID', '127.0.0.1:5000'),
         'LAST_EXECUTION_FILE': 'last_execution.txt',
         'INDEX_FILES_TIME': 1,
-        'PEER_DISCOVER_INTERVAL': 1,
+        'GOSSIP_INTERVAL': 30,
+        'GOSSIP_FANOUT': 3,
+        'GOSSIP_MISMATCH_THRESHOLD': 3,
         'DIRECTORY': os.getenv("SHARED_DIRECTORY"),
         'URL': 'https://raw.githubusercontent.com/username/repository/branch/path/to/file.json',
         'HEARTBEAT_INTERVAL': 10,
+        'HEARTBEAT_WORKERS': 32,
+        'HEARTBEAT_FAILURE_THRESHOLD': 3,
+        'BLOOM_REFRESH_INTERVAL': 30,
+        'BLOOM_ERROR_RATE': 0.01,
+        'SEARCH_RESULT_LIMIT': 200,
+        'SEARCH_TIMEOUT': 10,
+        'HEDGE_DELAY': 0.5,
+        'CIRCUIT_FAILURE_THRESHOLD': 3,
+        'CIRCUIT_COOLDOWN': 60,
+        'SEARCH_ROUTING': 'mesh',
+        'SEARCH_FANOUT': 8,
+        'SEARCH_TTL': 3,
+        'SEARCH_MAX_TTL': 5,
+        'CATALOG_REPLICATION': False,
+        'CATALOG_SYNC_INTERVAL': 15,
+        'SWARM_CHUNK_SIZE': 4 * 1024 * 1024,
+        'SWARM_PARALLEL': 4,
+        'SEARCH_CONCURRENCY': 16,
+        'SEARCH_LOCAL_RESERVED': 4,
+        'SEARCH_PEER_CONCURRENCY': 2,
+        'SEARCH_PEER_RATE': 5,
+        'SEARCH_PEER_BURST': 20,
+        'SEARCH_GLOBAL_RATE': 50,
+        'SEARCH_GLOBAL_BURST': 100,
+        'DOWNLOAD_CONCURRENCY': 24,
+        'ADMISSION_QUEUE_TIMEOUT': 5,
+        'MEMORY_CATALOG': False,
+        'MEMORY_CATALOG_INTERVAL': 60,
         'known_nodes': set(os.getenv('KNOWN_NODES', '').split(', ')),
     }
 
-def _save_settings():
-    """Save the current settings to the JSON file."""
-    # Convert 'known_nodes' from set to list before saving
-    settings_to_save = settings.copy()
-    if 'known_nodes' in settings_to_save:
-        settings_to_save['known_nodes'] = list(settings_to_save['known_nodes'])
-    
-    with open(SETTINGS_FILE, 'w') as f:
-        json.dump(settings_to_save, f, indent=4)
+def _commit_version(conn):
+    """
+    Bump the settings version after a write.
+
+    Returns:
+        bool: True if no other process wrote since our last reload, so the cache
+        can be patched in place instead of reloaded.
+    """
+    global _settings_version
+    conn.execute("UPDATE settings_meta SET version = version + 1;")
+    version = conn.execute("SELECT version FROM settings_meta;").fetchone()[0]
+    if version == _settings_version + 1:
+        _settings_version = version
+        return True
+    return False
 
 def get_setting(key, default=None):
     """Retrieve a setting value by key."""
-    return settings.get(key, default)
+    with _lock:
+        _refresh_if_changed()
+        value = settings.get(key, default)
+        # Callers get their own copy, so changing it doesn't touch the cache
+        return set(value) if isinstance(value, set) else value
 
 def set_setting(key, value):
-    """Set a setting value and save the updated settings to the file."""
-    settings[key] = value
-    _save_settings()
+    """Set a setting value, writing only the rows that changed."""
+    with _lock:
+        if key == 'known_nodes':
+            value = set(value)
+            current = get_setting('known_nodes')
+            update_known_nodes(added=value - current, removed=current - value)
+            return
+
+        conn = _connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?);", (key, json.dumps(value)))
+            up_to_date = _commit_version(conn)
+        if up_to_date:
+            settings[key] = value
+        else:
+            _reload(conn)
+
+def update_known_nodes(added=(), removed=()):
+    """
+    Add and remove known nodes without rewriting the whole list.
+
+    Args:
+        added (iterable): Nodes to add.
+        removed (iterable): Nodes to remove.
+    """
+    added = {node for node in added if node}
+    removed = set(removed)
+    if not added and not removed:
+        return
+
+    with _lock:
+        conn = _connection()
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO known_nodes (node_id) VALUES (?);", ((node,) for node in added))
+            conn.executemany("DELETE FROM known_nodes WHERE node_id = ?;", ((node,) for node in removed))
+            up_to_date = _commit_version(conn)
+        if up_to_date:
+            settings['known_nodes'] = (settings['known_nodes'] | added) - removed
+        else:
+            _reload(conn)
 
 def return_all():
-    return settings
+    """Return a copy of every setting."""
+    with _lock:
+        _refresh_if_changed()
+        return {key: set(value) if isinstance(value, set) else value for key, value in settings.items()}
 
 # Automatically load settings when the module is imported
 load_settings()
-
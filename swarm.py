@@ -0,0 +1,170 @@
+import hashlib
+import logging
+import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import search
+import indexer
+
+logger = logging.getLogger(__name__)
+
+def build_manifest(md5_hash, known_nodes, node_id, conn, chunk_size):
+    """
+    Resolve every node hosting an md5 hash and split the file into byte ranges.
+
+    Args:
+        md5_hash (str): The md5 hash of the file.
+        known_nodes (set): Nodes known to the current node.
+        node_id (str): The ID of the current node.
+        conn (sqlite3.Connection): Connection to the local index.
+        chunk_size (int): Size of each byte range.
+
+    Returns:
+        dict: The manifest, with 'file_name', 'file_size', 'chunk_size', 'sources'
+        (download URLs that won't redirect), 'chunks' ([start, end] inclusive) and, when at least
+        two hosts agree on them, 'chunk_hashes' and 'merkle_root'. None if no node has the file.
+    """
+    results = search.global_search(md5_hash, known_nodes, node_id, conn, "md5", limit=1)
+    if not results:
+        return None
+
+    result = results[0]
+    file_size = result['file_size']
+    download_urls = [source['download_url'] for source in result['sources']]
+
+    # Use the hosts' chunk hashes when they agree, so each chunk can be verified on arrival
+    chunk_hashes = fetch_chunk_hashes(md5_hash, download_urls)
+    if chunk_hashes:
+        chunk_size = chunk_hashes['chunk_size']
+
+    return {
+        'md5_hash': md5_hash,
+        'file_name': result['file_name'],
+        'file_size': file_size,
+        'chunk_size': chunk_size,
+        'merkle_root': chunk_hashes['merkle_root'] if chunk_hashes else None,
+        'chunk_hashes': chunk_hashes['chunks'] if chunk_hashes else None,
+        'sources': [f"{url}?resolve=0" for url in download_urls],
+        'chunks': [[start, min(start + chunk_size, file_size) - 1] for start in range(0, file_size, chunk_size)],
+    }
+
+def fetch_chunk_hashes(md5_hash, download_urls, timeout=10, min_agreement=2):
+    """
+    Get the chunk hashes of a file once enough sources agree on them.
+
+    A host could list made-up hashes with a matching Merkle root, since nothing
+    ties the root to the md5. A set is only used once min_agreement sources
+    return the same root; otherwise the download relies on the final md5 check.
+
+    Args:
+        md5_hash (str): The md5 hash of the file.
+        download_urls (list): Download URLs of the nodes hosting the file.
+        timeout (int): Timeout for each request in seconds.
+        min_agreement (int): Number of sources that must return the same root.
+
+    Returns:
+        dict: The /chunks response, or None if not enough sources agree.
+    """
+    if len(download_urls) < min_agreement:
+        return None
+
+    votes = {}
+    for url in download_urls:
+        chunks_url = url.replace(f"/download/{md5_hash}", f"/chunks/{md5_hash}")
+        try:
+            response = requests.get(chunks_url, timeout=timeout)
+            if response.status_code != 200:
+                continue
+            hashes = response.json()
+            if indexer.merkle_root(bytes.fromhex(chunk) for chunk in hashes['chunks']) != hashes['merkle_root']:
+                logger.warning("Chunk hashes from %s don't match their Merkle root", chunks_url)
+                continue
+        except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+            logger.warning("Could not fetch chunk hashes from %s: %s", chunks_url, e)
+            continue
+        key = (hashes['chunk_size'], hashes['merkle_root'])
+        first, count = votes.get(key, (hashes, 0))
+        if count + 1 >= min_agreement:
+            return first
+        votes[key] = (first, count + 1)
+
+    if len(votes) > 1:
+        logger.warning("Sources of %s disagree on its chunk hashes, relying on the md5 check", md5_hash)
+    return None
+
+def fetch_chunk(manifest, index, timeout=30):
+    """
+    Download one chunk, trying each source in turn until one returns the full range.
+
+    Sources are rotated by chunk index so consecutive chunks come from different nodes.
+    When the manifest has chunk hashes, a chunk that doesn't match its hash is
+    fetched again from the next source instead of failing the whole download.
+
+    Args:
+        manifest (dict): The manifest built by build_manifest().
+        index (int): Index of the chunk in manifest['chunks'].
+        timeout (int): Timeout for each request in seconds.
+
+    Returns:
+        bytes: The chunk data.
+    """
+    start, end = manifest['chunks'][index]
+    sources = manifest['sources']
+    expected = manifest['chunk_hashes'][index] if manifest['chunk_hashes'] else None
+    for attempt in range(len(sources)):
+        url = sources[(index + attempt) % len(sources)]
+        try:
+            response = requests.get(url, headers={"Range": f"bytes={start}-{end}"}, timeout=timeout)
+            if response.status_code == 206 and len(response.content) == end - start + 1:
+                if expected is None or hashlib.sha256(response.content).hexdigest() == expected:
+                    return response.content
+                logger.warning("Chunk %s from %s failed hash verification, retrying from another source", index, url)
+                continue
+            logger.warning("Chunk %s from %s rejected: status %s, %s bytes", index, url, response.status_code, len(response.content))
+        except requests.RequestException as e:
+            logger.warning("Chunk %s from %s failed: %s", index, url, e)
+    raise IOError(f"No source could deliver chunk {index} of {manifest['md5_hash']}")
+
+def stream_file(manifest, parallel=4):
+    """
+    Fetch chunks from several sources in parallel and yield them in order.
+
+    At most `parallel` chunks are in flight, which bounds memory to about
+    parallel * chunk_size. The last chunk is held back until the whole file
+    matches its md5; on a mismatch it is never sent, so a client expecting
+    Content-Length bytes sees an incomplete transfer instead of a silently
+    corrupt file.
+
+    Args:
+        manifest (dict): The manifest built by build_manifest().
+        parallel (int): Number of chunks downloaded at the same time.
+
+    Yields:
+        bytes: The file contents, chunk by chunk.
+    """
+    md5 = hashlib.md5()
+    chunk_count = len(manifest['chunks'])
+    executor = ThreadPoolExecutor(max_workers=parallel)
+    pending = deque()
+    next_chunk = 0
+    held = b""
+    try:
+        while next_chunk < chunk_count or pending:
+            while next_chunk < chunk_count and len(pending) < parallel:
+                pending.append(executor.submit(fetch_chunk, manifest, next_chunk))
+                next_chunk += 1
+            data = pending.popleft().result()
+            md5.update(data)
+            if held:
+                yield held
+            held = data
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+    if md5.hexdigest() != manifest['md5_hash']:
+        logger.error("Swarm download of %s failed verification, got %s", manifest['md5_hash'], md5.hexdigest())
+        raise IOError(f"md5 mismatch for {manifest['md5_hash']}")
+    logger.info("Swarm download of %s verified from %s sources", manifest['md5_hash'], len(manifest['sources']))
+    yield held
@@ -1,9 +1,28 @@
+import argparse
 import indexer
 import database
-import sys
+from log_config import setup_logging
 
-path = sys.argv[1]
+setup_logging()
+
+parser = argparse.ArgumentParser(description="Index a directory, or import checksum manifests into the index.")
+parser.add_argument("path", nargs="?", help="directory to index, reading every file")
+parser.add_argument("--import-manifest", nargs="+", metavar="MANIFEST",
+                    help="md5sum, .md5 or .sfv manifests to import instead of reading every file")
+parser.add_argument("--root", help="directory manifest paths are relative to, defaults to each manifest's directory")
+parser.add_argument("--verify-sample", type=int, default=0, metavar="N",
+                    help="hash N random files of each manifest first, and skip the manifest on any mismatch")
+args = parser.parse_args()
+if not args.path and not args.import_manifest:
+    parser.error("give a directory to index or --import-manifest")
 
 conn = database.create_sqlite_connection()
 
-indexer.indexer(path, conn)
+# Import first: indexing afterwards reuses the imported hashes instead of reading those files again
+for manifest in args.import_manifest or []:
+    indexer.import_manifest(manifest, conn, args.root, args.verify_sample)
+
+if args.path:
+    indexer.indexer(args.path, conn)
+else:
+    conn.close()